@@ -0,0 +1,194 @@
+import argparse
+import os
+from os import path, makedirs
+
+import numpy as np
+import pandas as pd
+import utm
+
+# Generates synthetic users in the format we received the data in (each user-folder holding: analysis.xlsx, source.csv,
+# stops.csv), so they can be converted with convert.py and used by the webapp (see run.py).
+# Every user lives at home, works on weekdays and visits a few other places in the evenings and on weekends.
+# The samples are spread evenly over the days, samples during stops are scattered around the place, samples
+# during trips lie on the straight line between two places.
+# Run it from the main directory: "python benchmarks/generate.py --users 3 --samples 100000 --days 30 user_data"
+
+START = pd.Timestamp("2022-03-28 00:00:00", tz="Europe/Berlin")
+
+# all users live around this point
+CENTER = (52.52, 13.40)
+
+# number of places (besides home and work) a user visits
+OTHER_PLACES = 5
+
+# columns of the mobility report, like in the reports we received
+REPORT_COLUMNS = ["time", "interval (sec)", "stops", "different revisited locations", "revisited location visits",
+                  "unique locations", "trips", "total trip path distance (km)", "mean trip path distance (km)",
+                  "total trip duration (min)", "mean trip duration (min)", "max distance to home (stops, km)",
+                  "mean distance to home (stops, km)", "max distance to home (all points, km)",
+                  "mean distance to home (all points, km)", "time at home (min)", "time out of home (min)",
+                  "time out of home (%)", "time first move", "time last move", "area convex hull (stops, km2)",
+                  "perimeter convex hull (stops, km)", "area convex hull (trips, km2)", "perimeter convex hull (trips, km)"]
+
+
+# returns the places of a user as array of [latitude, longitude], 0 is home, 1 is work
+def generatePlaces(rng):
+    home = np.array(CENTER) + rng.normal(0, 0.05, 2)
+    others = home + rng.normal(0, 0.03, (OTHER_PLACES + 1, 2))
+    return np.vstack([home, others])
+
+
+# returns the visits of a user as list of (place, start, end) in seconds since START, sorted and without gaps
+# between two visits there is a trip
+def generateVisits(rng, days):
+    visits = []
+
+    def visit(place, start, end):
+        # consecutive visits of the same place are one visit
+        if visits and visits[-1][0] == place:
+            visits[-1] = (place, visits[-1][1], end)
+        else:
+            visits.append((place, start, end))
+
+    for day in range(days):
+        base = day * 86400
+        weekday = (START + pd.Timedelta(days=day)).weekday()
+
+        if weekday < 5:
+            leave = base + 7 * 3600 + rng.integers(0, 3600)
+            visit(0, base, leave)
+            arrive = leave + rng.integers(900, 2700)
+            leave = base + 16 * 3600 + rng.integers(0, 7200)
+            visit(1, arrive, leave)
+        else:
+            leave = base + 10 * 3600 + rng.integers(0, 3600)
+            visit(0, base, leave)
+
+        # some evenings (and every weekend) another place is visited
+        if weekday >= 5 or rng.random() < 0.5:
+            arrive = leave + rng.integers(900, 2700)
+            leave = arrive + rng.integers(3600, 3 * 3600)
+            visit(2 + rng.integers(0, OTHER_PLACES), arrive, leave)
+
+        visit(0, leave + rng.integers(900, 2700), base + 86400)
+
+    return visits
+
+
+# formats timestamps like the data we received ("2022-03-30 20:42:37+02:00")
+def formatTimestamps(seconds):
+    local = START + pd.to_timedelta(np.asarray(seconds), unit="s")
+    text = pd.Series(local.strftime("%Y-%m-%d %H:%M:%S%z"))
+    return (text.str[:-2] + ":" + text.str[-2:]).to_numpy()
+
+
+def utmCoordinates(latitude, longitude):
+    x, y, _, _ = utm.from_latlon(np.asarray(latitude), np.asarray(longitude), force_zone_number=33)
+    return x, y
+
+
+def generateSamples(rng, places, visits, samples, days):
+    ts = np.sort(rng.uniform(0, days * 86400, samples)).astype(np.int64)
+
+    starts = np.array([v[1] for v in visits])
+    ends = np.array([v[2] for v in visits])
+    visit_places = np.array([v[0] for v in visits])
+
+    # the last visit starting before every sample, samples after its end are on the way to the next one
+    i = np.clip(np.searchsorted(starts, ts, side="right") - 1, 0, len(visits) - 1)
+    at_place = ts < ends[i]
+    following = np.minimum(i + 1, len(visits) - 1)
+
+    # how far the trip from the last place to the next one has progressed
+    duration = np.maximum(starts[following] - ends[i], 1)
+    progress = np.clip((ts - ends[i]) / duration, 0, 1)
+    position = places[visit_places[i]] + (places[visit_places[following]] - places[visit_places[i]]) * progress[:, None]
+
+    # scattered around the place during stops, a little noise while moving
+    position += rng.normal(0, 0.0002, position.shape) * np.where(at_place, 1, 0.2)[:, None]
+
+    motion_score = np.where(at_place, rng.uniform(0, 50, samples), rng.uniform(150, 1000, samples))
+
+    latitude, longitude = position[:, 0], position[:, 1]
+    x, y = utmCoordinates(latitude, longitude)
+    return pd.DataFrame({"ts": formatTimestamps(ts), "x": x, "y": y, "longitude": longitude, "latitude": latitude,
+                         "motion_score": motion_score})
+
+
+def generateStops(rng, places, visits):
+    start = np.array([v[1] for v in visits])
+    end = np.array([v[2] for v in visits])
+    place = np.array([v[0] for v in visits])
+
+    position = places[place] + rng.normal(0, 0.00005, (len(visits), 2))
+    x, y = utmCoordinates(position[:, 0], position[:, 1])
+    return pd.DataFrame({"start": formatTimestamps(start), "stop": formatTimestamps(end), "duration": (end - start).astype(float),
+                         "x": x, "y": y, "longitude": position[:, 1], "latitude": position[:, 0], "unique_id": place})
+
+
+# returns a mobility report with the same columns as the reports we received, the values are only roughly plausible
+def generateReport(rng, places, visits, days):
+    rows = []
+    for day in range(days):
+        base = day * 86400
+        day_visits = [v for v in visits if base <= v[1] < base + 86400]
+        trips = max(len(day_visits) - 1, 0)
+        away = sum(min(v[2], base + 86400) - max(v[1], base) for v in day_visits if v[0] != 0) / 60
+        distances = [float(np.hypot(*(places[v[0]] - places[0])) * 111) for v in day_visits]
+        first_move = formatTimestamps([day_visits[0][2]])[0][11:16] if day_visits else ""
+        last_move = formatTimestamps([day_visits[-1][1]])[0][11:16] if day_visits else ""
+        rows.append([str((START + pd.Timedelta(days=day)).date()), 86400.0, len(day_visits), len(set(v[0] for v in day_visits)) - 1,
+                     trips, len(set(v[0] for v in day_visits)), trips, round(trips * rng.uniform(3, 15), 3),
+                     round(rng.uniform(3, 15), 3), round(trips * rng.uniform(10, 40), 1), round(rng.uniform(10, 40), 1),
+                     round(max(distances, default=0), 3), round(float(np.mean(distances)) if distances else 0, 3),
+                     round(max(distances, default=0), 3), round(float(np.mean(distances)) if distances else 0, 3),
+                     round(1440 - away, 1), round(away, 1), round(100 * away / 1440, 2), first_move or "no trip",
+                     last_move, "", "", round(rng.uniform(0, 50), 3), round(rng.uniform(0, 50), 3)])
+
+    report = pd.DataFrame(rows, columns=REPORT_COLUMNS)
+    whole = ["whole period", float(days * 86400), len(visits), OTHER_PLACES, int(report["revisited location visits"].sum()),
+             len(places), int(report["trips"].sum()), round(report["total trip path distance (km)"].sum(), 3),
+             round(report["mean trip path distance (km)"].mean(), 3), round(report["total trip duration (min)"].sum(), 1),
+             round(report["mean trip duration (min)"].mean(), 1), report["max distance to home (stops, km)"].max(),
+             round(report["mean distance to home (stops, km)"].mean(), 3), report["max distance to home (all points, km)"].max(),
+             round(report["mean distance to home (all points, km)"].mean(), 3), round(report["time at home (min)"].sum(), 1),
+             round(report["time out of home (min)"].sum(), 1), round(report["time out of home (%)"].mean(), 2),
+             report["time first move"].iloc[0], report["time last move"].iloc[-1], round(rng.uniform(50, 300), 3),
+             round(rng.uniform(20, 80), 3), round(rng.uniform(50, 400), 3), round(rng.uniform(20, 90), 3)]
+    return pd.concat([pd.DataFrame([whole], columns=REPORT_COLUMNS), report], ignore_index=True)
+
+
+# writes a single user in the format we received the data in
+def generateUser(directory, samples, days, seed=0):
+    rng = np.random.default_rng(seed)
+    makedirs(directory, exist_ok=True)
+
+    places = generatePlaces(rng)
+    visits = generateVisits(rng, days)
+
+    generateSamples(rng, places, visits, samples, days).to_csv(path.join(directory, "source.csv"), index=False)
+    generateStops(rng, places, visits).to_csv(path.join(directory, "stops.csv"), index=False)
+    generateReport(rng, places, visits, days).to_excel(path.join(directory, "analysis.xlsx"), index=False)
+
+
+# writes "users" users ("bench0", "bench1", ...) into the directory, returns their usernames
+def generateDataset(directory, users, samples, days, seed=0):
+    usernames = []
+    for i in range(users):
+        username = "bench" + str(i)
+        generateUser(path.join(directory, username), samples, days, seed + i)
+        usernames.append(username)
+    return usernames
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic users in the format of the delivered data.")
+    parser.add_argument("directory", help="folder the users are written into (e.g. user_data)")
+    parser.add_argument("--users", type=int, default=3, help="number of users")
+    parser.add_argument("--samples", type=int, default=100000, help="number of gps samples per user")
+    parser.add_argument("--days", type=int, default=30, help="number of days per user")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random numbers")
+    args = parser.parse_args()
+
+    generateDataset(os.path.abspath(args.directory), args.users, args.samples, args.days, args.seed)
+    print("Generated " + str(args.users) + " user(s) in '" + args.directory + "'.")
@@ -0,0 +1,197 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from os import path, makedirs
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pandas as pd
+from flask import Flask
+
+import convert
+from generate import generateDataset, START
+from website import db
+from website.models import User, Stop_h, Stop_w
+from website.auth import calculateSigLocs
+from website.geocoding import Geocoder, StaticBackend, GeocodeCache
+from website.map import buildmap, build_date_map, getHomeLoc, getWorkLoc, metadata, snapshotUser
+
+# Times the hot paths of the webapp on synthetic users (see generate.py) and saves the results as json, so runs of
+# different versions can be compared ("--compare"). Run it from the main directory: "python benchmarks/run.py".
+# Everything happens in a temporary directory with its own database, the app's data and database aren't touched.
+# Every benchmark is run once with empty caches ("first") and then "--repeat" times again (min, median, mean),
+# every run covers all users. Addresses are looked up with a local stand-in for Nominatim (StaticBackend).
+
+RESULTS_DIR = path.join(ROOT, "benchmarks", "results")
+
+
+# runs function once and then "repeat" times again, setup (not timed) is called before every run
+def measure(function, repeat, setup=None):
+    times = []
+    for _ in range(repeat + 1):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    return {"first": times[0], "min": min(times[1:]), "median": statistics.median(times[1:]),
+            "mean": statistics.mean(times[1:]), "repeat": repeat}
+
+
+# app with only the database, which is saved in the benchmark's directory
+def createBenchmarkApp(directory):
+    app = Flask("benchmark")
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + path.join(directory, "benchmark.db")
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.secret_key = "benchmark"
+    db.init_app(app)
+    return app
+
+
+def gitCommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def runBenchmarks(directory, users, samples, days, repeat, processes, seed):
+    results = {}
+
+    print("Generating " + str(users) + " user(s) with " + str(samples) + " samples over " + str(days) + " days...")
+    raw_dir = path.join(directory, "raw")
+    usernames = generateDataset(raw_dir, users, samples, days, seed)
+
+    # convert.py changes the files it converts, so every run gets a fresh copy
+    convert_dir = path.join(directory, "convert")
+
+    def copyRaw():
+        shutil.rmtree(convert_dir, ignore_errors=True)
+        shutil.copytree(raw_dir, convert_dir)
+
+    def convertAll():
+        for username in usernames:
+            convert.convert_user(path.join(convert_dir, username), force=True)
+
+    results["convert"] = measure(convertAll, repeat, setup=copyRaw)
+
+    # the converted users are the data of the app
+    shutil.copytree(convert_dir, path.join(directory, "data"))
+    os.chdir(directory)
+
+    app = createBenchmarkApp(directory)
+    with app.app_context():
+        db.create_all()
+        for username in usernames:
+            db.session.add(User(username=username, password=username, sigLoc_loaded=False,
+                                survey_part1_answered=True, survey_part2_answered=False))
+        db.session.commit()
+
+        geocoder = {}
+
+        def resetSigLocs():
+            Stop_h.query.delete()
+            Stop_w.query.delete()
+            User.query.update({User.sigLoc_loaded: False})
+            db.session.commit()
+            geocoder["geocoder"] = Geocoder(StaticBackend(), GeocodeCache(":memory:"), rate_limit=0)
+
+        results["calculateSigLocs"] = measure(lambda: calculateSigLocs(geocoder=geocoder["geocoder"], processes=processes),
+                                              repeat, setup=resetSigLocs)
+
+        snapshots = [snapshotUser(user) for user in User.query.order_by(User.id)]
+
+    stops = [pd.read_csv(path.join("data", username, "stops.csv")) for username in usernames]
+    homes = [getHomeLoc(s) for s in stops]
+
+    results["getHomeLoc"] = measure(lambda: [getHomeLoc(s) for s in stops], repeat)
+    results["getWorkLoc"] = measure(lambda: [getWorkLoc(s, home) for s, home in zip(stops, homes)], repeat)
+
+    # maps are rendered to html as well, like when they are saved (see rendercache.py)
+    results["buildmap"] = measure(lambda: [buildmap(user).get_root().render() for user in snapshots], repeat)
+
+    start_date = str((START + pd.Timedelta(days=days // 4)).date())
+    end_date = str((START + pd.Timedelta(days=max(days // 2, 1))).date())
+    results["build_date_map"] = measure(lambda: [build_date_map(user, start_date, end_date, "08:00", "20:00").get_root().render()
+                                                 for user in snapshots], repeat)
+
+    results["metadata"] = measure(lambda: [metadata(user) for user in snapshots], repeat)
+
+    return results
+
+
+def printResults(results, users, previous=None):
+    print("\n%-20s %10s %10s %12s %10s" % ("benchmark", "first (s)", "median (s)", "per user (s)", "change"))
+    for name, result in results.items():
+        change = ""
+        if previous is not None and name in previous.get("results", {}):
+            before = previous["results"][name]["median"]
+            if before > 0:
+                change = "%+.0f%%" % (100 * (result["median"] - before) / before)
+        print("%-20s %10.4f %10.4f %12.4f %10s" % (name, result["first"], result["median"], result["median"] / users, change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the webapp on synthetic users.")
+    parser.add_argument("--users", type=int, default=3, help="number of users")
+    parser.add_argument("--samples", type=int, default=100000, help="number of gps samples per user")
+    parser.add_argument("--days", type=int, default=30, help="number of days per user")
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs after the first one")
+    parser.add_argument("--processes", type=int, default=1, help="processes used by calculateSigLocs")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic data")
+    parser.add_argument("--output", default=None, help="json file of the results (default: benchmarks/results/<date>.json)")
+    parser.add_argument("--compare", default=None, help="json file of an earlier run to compare with")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary directory with the synthetic data")
+    args = parser.parse_args()
+
+    if args.repeat < 1:
+        parser.error("--repeat has to be at least 1")
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+
+    directory = tempfile.mkdtemp(prefix="loctrace-benchmark-")
+    cwd = os.getcwd()
+    try:
+        results = runBenchmarks(directory, args.users, args.samples, args.days, args.repeat, args.processes, args.seed)
+    finally:
+        os.chdir(cwd)
+        if args.keep:
+            print("Synthetic data kept in '" + directory + "'.")
+        else:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    report = {"date": datetime.now().isoformat(timespec="seconds"),
+              "commit": gitCommit(),
+              "python": platform.python_version(),
+              "machine": platform.machine(),
+              "cpus": os.cpu_count(),
+              "parameters": {"users": args.users, "samples": args.samples, "days": args.days, "repeat": args.repeat,
+                             "processes": args.processes, "seed": args.seed},
+              "results": results}
+
+    output = args.output
+    if output is None:
+        makedirs(RESULTS_DIR, exist_ok=True)
+        output = path.join(RESULTS_DIR, datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    with open(output, "w") as f:
+        json.dump(report, f, indent=1)
+
+    printResults(results, args.users, previous)
+    print("\nResults saved in '" + output + "'.")
+
+
+if __name__ == "__main__":
+    main()
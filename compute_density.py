@@ -0,0 +1,24 @@
+import argparse
+import time
+from website.densitygrid import computeDensityGrid, cohortUsers, DENSITY_FILE, DENSITY_WEIGHT
+
+# Bins the gps samples (or stops) of all users in "data/" into the density grid shown on "/admin/density/"
+# (see website/densitygrid.py). Run it from the main directory: "python compute_density.py", and again whenever
+# data has been added. The users are binned in parallel, use "--processes" to set the number of processes.
+
+parser = argparse.ArgumentParser(description="Compute the density grid of the whole cohort.")
+parser.add_argument("--weight", choices=["samples", "stops"], default=DENSITY_WEIGHT,
+                    help="count gps samples or the duration of stops (default: " + DENSITY_WEIGHT + ")")
+parser.add_argument("--processes", type=int, default=None, help="number of processes (default: number of cpus)")
+parser.add_argument("--output", default=DENSITY_FILE, help="file of the grid (default: " + DENSITY_FILE + ")")
+args = parser.parse_args()
+
+start = time.time()
+usernames = cohortUsers()
+print("Compute density grid of " + str(len(usernames)) + " user(s)...")
+
+grid = computeDensityGrid(usernames, weight=args.weight, processes=args.processes)
+grid.save(args.output)
+
+print("Density grid saved in '" + args.output + "' after " + str(round(time.time() - start, 2)) + " seconds ("
+      + str(len(grid.levels[max(grid.levels)][0])) + " cells at the highest zoom level).")
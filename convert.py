@@ -1,4 +1,10 @@
+import argparse
+import hashlib
+import json
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
 import utm
 
@@ -7,39 +13,197 @@ import utm
 
 #runs fine on python 3.8.10. Not supposed to be running on the server. 
 
-main_folder = os.path.join(os.getcwd(), "user_data")
-for user_folder in os.listdir(main_folder):
-    print(user_folder+":")
+# Run it from the main directory: "python convert.py". Users are converted in parallel ("--processes").
+# After a user was converted, a manifest (MANIFEST_FILE) with the hashes of the user's files is saved in the user's folder.
+# Users whose files haven't changed since are skipped, "--force" converts all users again.
+
+# UTM zone of the stops' x and y, if stops.csv has no "zone_number"/"zone_letter" columns
+UTM_ZONE_NUMBER = 33
+UTM_ZONE_LETTER = 'U'
+
+MAIN_FOLDER = "user_data"
+
+MANIFEST_FILE = "convert_manifest.json"
+
+# increase this, if the conversion changes, so all users are converted again
+CONVERTER_VERSION = 1
+
+# files of a user after the conversion
+OUTPUT_FILES = ("gps_samples_and_motion_score.csv", "mobility_report.csv", "stops.csv")
+
+# assigns the unique_id of the stop every sample belongs to (start <= ts <= stop) as 'stop_id', -1 if there is none
+# sorted interval join: the first and last sample of every stop are found by binary search on the sorted timestamps,
+# so every sample is only touched by the stops containing it. stops are applied in their order, so if stops overlap,
+# later stops overwrite earlier ones (like going over every stop and every sample would)
+def align_samples_to_stops(samples_df, stops_df):
+    ts = samples_df.ts.values
+    order = None
+    if len(ts) > 1 and np.any(ts[1:] < ts[:-1]):
+        order = np.argsort(ts, kind='stable')
+        ts = ts[order]
+
+    first = np.searchsorted(ts, stops_df.start.values, side='left')
+    last = np.searchsorted(ts, stops_df.stop.values, side='right')
+
+    stop_id = np.full(len(ts), -1, dtype=np.int64)
+    for lo, hi, unique_id in zip(first, last, stops_df.unique_id.values):
+        stop_id[lo:hi] = unique_id
+
+    if order is not None:
+        unsorted = np.empty_like(stop_id)
+        unsorted[order] = stop_id
+        stop_id = unsorted
+
+    samples_df['stop_id'] = stop_id
+    return samples_df
+
+
+# returns longitude and latitude of every stop, taken from the first sample belonging to the stop's unique_id
+def stop_coordinates_from_tracks(stops, tracks):
+    # first sample of every stop_id (like groupby().first(), but without skipping missing values)
+    first = tracks.drop_duplicates('stop_id').set_index('stop_id')
+    longitude = stops['unique_id'].map(first['longitude']).to_numpy()
+    latitude = stops['unique_id'].map(first['latitude']).to_numpy()
+    return longitude, latitude
+
+
+# converts the stops' UTM coordinates (x, y) to latitude and longitude, all stops of a zone in one call
+# stops out of the zone's bounds get the coordinates taken from the track instead
+def stop_coordinates_from_utm(stops, longitude_tracks, latitude_tracks, log):
+    x = stops["x"].to_numpy(dtype=float)
+    y = stops["y"].to_numpy(dtype=float)
+
+    zone_number = stops["zone_number"].to_numpy() if "zone_number" in stops else np.full(len(stops), UTM_ZONE_NUMBER)
+    zone_letter = stops["zone_letter"].to_numpy() if "zone_letter" in stops else np.full(len(stops), UTM_ZONE_LETTER)
+
+    #for some reason, a OUTOFBOUNDS error occurs with some users. they may have been moving too far from the 33U zone, idk
+    #in order to still provide a coordinate, one is taken from the track (stops and tracks are now linked via id)
+    out_of_bounds = (x < 100000) | (x > 999999) | (y < 0) | (y > 10000000)
+    if out_of_bounds.any():
+        log.append("\tOUT OF BOUNDS: " + str(out_of_bounds.sum()) + " stop(s), using coordinates of the track")
+
+    longitude = np.array(longitude_tracks, dtype=float)
+    latitude = np.array(latitude_tracks, dtype=float)
+
+    #all stops of a zone are converted at once, the coordinates equal those converted stop by stop within float rounding
+    zones = pd.DataFrame({"number": zone_number, "letter": zone_letter})[~out_of_bounds]
+    for (number, letter), rows in zones.groupby(["number", "letter"]).groups.items():
+        lat_utm, long_utm = utm.to_latlon(x[rows], y[rows], int(number), letter)
+        latitude[rows] = lat_utm
+        longitude[rows] = long_utm
+
+    return longitude, latitude
+
+
+# reads an excel file row by row with openpyxl's read-only mode (much faster and smaller than loading the whole workbook)
+# the first row is the header. like pandas, whole numbers are written without decimals
+def read_excel_streaming(file):
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, ())
+        data = [[int(v) if isinstance(v, float) and v.is_integer() else v for v in row]
+                for row in rows if any(v is not None for v in row)]
+    finally:
+        workbook.close()
+    return pd.DataFrame(data, columns=header)
+
+
+def file_hash(file):
+    sha256 = hashlib.sha256()
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+# hash, size and modification time of the user's files that exist
+# hashes of files whose size and modification time are the same as in "previous" aren't computed again
+def file_versions(user_dir, files, previous=None):
+    previous = previous or {}
+    versions = {}
+    for f in files:
+        file = os.path.join(user_dir, f)
+        if not os.path.exists(file):
+            continue
+        st = os.stat(file)
+        old = previous.get(f)
+        if old is not None and old["size"] == st.st_size and old["mtime_ns"] == st.st_mtime_ns:
+            versions[f] = old
+        else:
+            versions[f] = {"sha256": file_hash(file), "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    return versions
+
+
+def read_manifest(user_dir):
+    try:
+        with open(os.path.join(user_dir, MANIFEST_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(user_dir, manifest):
+    file = os.path.join(user_dir, MANIFEST_FILE)
+    with open(file + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(file + ".tmp", file)
+
+
+# a user has to be converted, if new files were delivered (source.csv, analysis.xlsx) or the converted files changed
+def is_up_to_date(user_dir, manifest):
+    if manifest is None or manifest.get("version") != CONVERTER_VERSION:
+        return False
+    if os.path.exists(os.path.join(user_dir, "source.csv")) or os.path.exists(os.path.join(user_dir, "analysis.xlsx")):
+        return False
+    current = file_versions(user_dir, OUTPUT_FILES, manifest.get("outputs"))
+    recorded = manifest.get("outputs", {})
+    return set(current) == set(recorded) and all(current[f]["sha256"] == recorded[f]["sha256"] for f in current)
+
+
+# converts the files of a single user, returns "converted" or "skipped" and the log of the conversion
+# (users are converted in parallel, so the log is printed by the main process)
+def convert_user(user_dir, force=False):
+    log = [os.path.basename(user_dir) + ":"]
+
+    manifest = read_manifest(user_dir)
+    if not force and is_up_to_date(user_dir, manifest):
+        log.append("\tUnchanged, skipped.")
+        return "skipped", log
+
+    inputs = file_versions(user_dir, ("source.csv", "analysis.xlsx", "stops.csv"))
 
     ###rename gps file(s) - define needed files
-    old_file_gps = os.path.join(main_folder, user_folder, "source.csv")
-    new_file_gps = os.path.join(main_folder, user_folder, "gps_samples_and_motion_score.csv")
+    old_file_gps = os.path.join(user_dir, "source.csv")
+    new_file_gps = os.path.join(user_dir, "gps_samples_and_motion_score.csv")
 
     #rename file
     if os.path.exists(old_file_gps):
-        os.rename(old_file_gps, new_file_gps)
+        os.replace(old_file_gps, new_file_gps)
     else:
         if os.path.exists(new_file_gps):
-            print("\tFile already exists")
+            log.append("\tFile already exists")
         else:
-            print("\tNo file '"+ old_file_gps + "' found, can't rename.")
+            log.append("\tNo file '"+ old_file_gps + "' found, can't rename.")
 
 
 
     ###convert mobility_report file(s) - define needed files
-    old_file_mr = os.path.join(main_folder, user_folder, "analysis.xlsx")
-    new_file_mr = os.path.join(main_folder, user_folder, "mobility_report.csv")
+    old_file_mr = os.path.join(user_dir, "analysis.xlsx")
+    new_file_mr = os.path.join(user_dir, "mobility_report.csv")
    
     # convert & delete file afterwards
     if os.path.exists(old_file_mr):
-        read_file = pd.read_excel (old_file_mr, engine='openpyxl')
+        read_file = read_excel_streaming(old_file_mr)
         read_file.to_csv (new_file_mr, index = None, header=True)
         os.remove(old_file_mr)
     else:
         if os.path.exists(new_file_mr):
-            print("\tFile already exists")
+            log.append("\tFile already exists")
         else:
-            print("\tNo file '"+ new_file_mr + "' found, can't convert.")
+            log.append("\tNo file '"+ new_file_mr + "' found, can't convert.")
 
 
 
@@ -49,7 +213,9 @@ for user_folder in os.listdir(main_folder):
     samples_df = pd.read_csv(new_file_gps)
 
     # read stops
-    stops_df = pd.read_csv(os.path.join(main_folder, user_folder, "stops.csv"))
+    stops_file = os.path.join(user_dir, "stops.csv")
+    stops = pd.read_csv(stops_file)
+    stops_df = stops.copy()
 
     ##convert timestamps to timezone aware format (important)
     samples_df.ts = pd.to_datetime(samples_df.ts)
@@ -61,62 +227,60 @@ for user_folder in os.listdir(main_folder):
     stops_df = stops_df.set_index('stop').tz_convert('Europe/Berlin').reset_index()
     
 
-    ##iterate stops and add unique stop ID to corresponding samples
-    samples_df['stop_id'] = -1
-    for index, row in stops_df.iterrows():
-        selection = samples_df[(samples_df.ts >= row.start) & (samples_df.ts <= row.stop)].index
-        samples_df.loc[selection, 'stop_id'] = row.unique_id
+    ##add unique stop ID to corresponding samples
+    samples_df = align_samples_to_stops(samples_df, stops_df)
 
     # save new CSVs
     samples_df.to_csv(new_file_gps, index=False)
 
 
     # add long and lat to stops:
-    stops_file = os.path.join(os.path.join(main_folder, user_folder, "stops.csv"))
-    stops = pd.read_csv(stops_file)
-    tracks = pd.read_csv(new_file_gps)
+    ##find longitude and latitude by using the track's id
+    longitude_tracks, latitude_tracks = stop_coordinates_from_tracks(stops, samples_df)
 
-    longitude_list = []
-    latitude_list = []
-    longitude_list_utm = []
-    latitude_list_utm = []
+    ##find longitude and latitude by converting the UTM parameters to longitude and latitude
+    longitude_utm, latitude_utm = stop_coordinates_from_utm(stops, longitude_tracks, latitude_tracks, log)
 
+    #stops['longitude'] = longitude_tracks
+    #stops['latitude'] = latitude_tracks
+    stops['longitude'] = longitude_utm
+    stops['latitude'] = latitude_utm
 
-    for i in range(0, len(stops)):
-        ##find longitude and latitude by using the track's id 
-        row = tracks.loc[tracks['stop_id'] == stops.iloc[i]["unique_id"]]
+    #save file
+    stops.to_csv (stops_file, index = None, header=True)
 
-        lat = row.iloc[0]["latitude"]
-        long = row.iloc[0]["longitude"]
+    write_manifest(user_dir, {"version": CONVERTER_VERSION,
+                              "inputs": inputs,
+                              "outputs": file_versions(user_dir, OUTPUT_FILES)})
+    return "converted", log
 
-        longitude_list.append(long)
-        latitude_list.append(lat)
-        
-        ##find longitude and latitude by converting the UTM parameters to longitude and latitude
 
-        x = stops.iloc[i]["x"]
-        y = stops.iloc[i]["y"]
-        #print(f"x: {x}  y: {y}")
+def main():
+    parser = argparse.ArgumentParser(description="Convert the delivered user data into the format of the webapp.")
+    parser.add_argument("--folder", default=MAIN_FOLDER, help="folder holding one folder per user (default: user_data)")
+    parser.add_argument("--processes", type=int, default=None, help="number of processes (default: number of cpus)")
+    parser.add_argument("--force", action="store_true", help="convert all users again, even if they haven't changed")
+    args = parser.parse_args()
 
-        #for some reason, a OUTOFBOUNDS error occurs with some users. they may have been moving too far from the 33U zone, idk
-        #in order to still provide a coordinate, one is taken from the track (stops and tracks are now linked via id)
-        if x <100000 or x > 999999 or y < 0 or y > 10000000:
-            print("OUT OF BOUNDS")
-            longitude_list_utm.append(long)
-            latitude_list_utm.append(lat)
-        else:
-            lat_utm, long_utm = utm.to_latlon(x, y, 33, 'U')
+    start = time.time()
+    main_folder = os.path.join(os.getcwd(), args.folder)
+    user_dirs = [os.path.join(main_folder, user_folder) for user_folder in sorted(os.listdir(main_folder))
+                 if os.path.isdir(os.path.join(main_folder, user_folder))]
 
-            longitude_list_utm.append(long_utm)
-            latitude_list_utm.append(lat_utm)
-        
-        #print(f"Diff: {lat} - {lat_utm} = {'{:f}'.format(lat - lat_utm)} |\t {long} - {long_utm} = {'{:f}'.format(long - long_utm)}")
+    counts = {"converted": 0, "skipped": 0, "failed": 0}
+    with ProcessPoolExecutor(max_workers=args.processes) as executor:
+        futures = [(user_dir, executor.submit(convert_user, user_dir, args.force)) for user_dir in user_dirs]
+        for user_dir, future in futures:
+            try:
+                status, log = future.result()
+            except Exception as e:
+                status, log = "failed", [os.path.basename(user_dir) + ":", "\tConversion failed: " + repr(e)]
+            counts[status] += 1
+            print("\n".join(log))
 
-    #stops['longitude'] = longitude_list
-    #stops['latitude'] = latitude_list
-    stops['longitude'] = longitude_list_utm
-    stops['latitude'] = latitude_list_utm
+    print("Done after " + str(round(time.time() - start, 2)) + " seconds: " + str(counts["converted"]) + " converted, "
+          + str(counts["skipped"]) + " skipped, " + str(counts["failed"]) + " failed.")
 
-    #save file
-    stops.to_csv (stops_file, index = None, header=True)
-        
\ No newline at end of file
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+import argparse
+from os import path, makedirs
+from website import create_app
+from website.models import User, SurveyAnswer
+
+# Writes the survey answers saved in the database into "surveyData/part1/" and "surveyData/part2/", one csv file per
+# user (named after the username), which is the newest answer of the user to that part of the survey.
+# Run it from the main directory: "python export_survey.py". Existing files of the same users are overwritten.
+
+parser = argparse.ArgumentParser(description="Export the survey answers into csv files.")
+parser.add_argument("--directory", default="surveyData", help="folder the answers are written into (default: surveyData)")
+args = parser.parse_args()
+
+app = create_app(load_data=False)
+
+with app.app_context():
+    usernames = {user.id: user.username for user in User.query}
+
+    # newer answers overwrite older ones
+    newest = {}
+    for answer in SurveyAnswer.query.order_by(SurveyAnswer.received, SurveyAnswer.id):
+        newest[(answer.user_id, answer.part)] = answer
+
+    count = 0
+    for (user_id, part), answer in newest.items():
+        if user_id not in usernames:
+            print("Answer " + str(answer.id) + " belongs to no user, skipped.")
+            continue
+
+        directory = path.join(args.directory, "part" + str(part))
+        makedirs(directory, exist_ok=True)
+        with open(path.join(directory, usernames[user_id] + ".csv"), "wb") as binary_file:
+            binary_file.write(answer.data)
+        count += 1
+
+print("Exported " + str(count) + " answer(s) into '" + args.directory + "'.")
@@ -0,0 +1,31 @@
+import argparse
+import time
+from website import create_app, db
+from website.auth import load_database
+from website.models import User, Stop_h, Stop_w, State
+
+# Loads the users from "logindata.csv" into the database and calculates the significant locations of all users,
+# so this doesn't have to happen while the server starts. Run it from the main directory: "python precompute.py".
+# The significant locations are calculated in parallel, use "--processes" to set the number of processes.
+# "--force" deletes all significant locations and calculates them again (e.g. after data has changed).
+
+parser = argparse.ArgumentParser(description="Load users and calculate significant locations.")
+parser.add_argument("--processes", type=int, default=None, help="number of processes (default: number of cpus)")
+parser.add_argument("--force", action="store_true", help="calculate all significant locations again")
+args = parser.parse_args()
+
+start = time.time()
+app = create_app(load_data=False)
+
+with app.app_context():
+    if args.force:
+        print("Delete all significant locations...")
+        Stop_h.query.delete()
+        Stop_w.query.delete()
+        User.query.update({User.sigLoc_loaded: False})
+        State.query.update({State.sigLoc_loaded: False})
+        db.session.commit()
+
+    load_database(processes=args.processes)
+
+print("Database ready after " + str(round(time.time() - start, 2)) + " seconds.")
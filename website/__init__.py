@@ -10,7 +10,8 @@ db = SQLAlchemy()
 
 DB_NAME = "database.db"
 
-def create_app():
+#load_data: loads users and significant locations while starting, if this hasn't happened yet (see load_database() in auth.py)
+def create_app(load_data=True):
         app = Flask(__name__)
         #important for remembering users
         app.config["SECRET_KEY "] = "asdjfhakljsdgjf"
@@ -20,6 +21,9 @@ def create_app():
         #disables Flask-SQLAlchemy's event system, which is not used anyway
         app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+        #profiles every request with cProfile and saves the profiles in "profiles/" (see metrics.py), slows down requests
+        app.config['PROFILE_REQUESTS'] = False
+
         db.init_app(app)
 
         # Set the secret key to some random bytes. Keep this really secret!
@@ -37,10 +41,28 @@ def create_app():
         app.register_blueprint(views, url_prefix="/")
         app.register_blueprint(auth, url_prefix="/")
 
+        #times every request and serves the measurements on "/metrics"
+        from . import metrics
+        metrics.init_app(app)
+
+        #images, stylesheets and scripts are served with ETag/Last-Modified and Cache-Control (see assets.py)
+        from . import assets
+        assets.init_app(app)
+
+        #survey answers are saved by a background thread (see surveystore.py)
+        from .surveystore import survey_store
+        survey_store.init_app(app)
+
 
         from .models import User
         create_database(app)
 
+        #this can take a while the first time, it can also be done beforehand by running precompute.py
+        if load_data:
+            from .auth import load_database
+            with app.app_context():
+                load_database()
+
         #login_manager remembers logged-in users
         login_manager = LoginManager()
         login_manager.login_view = "auth.login"
@@ -63,4 +85,23 @@ def create_database(app):
         print("No old database found. Create a new one.")
 
     db.create_all(app=app)
+    addMissingColumns(app)
+
+
+#columns which have been added to existing tables later on (table, column, type)
+#create_all() only creates missing tables, so these columns are added to old databases here
+ADDED_COLUMNS = [
+    ("state", "logindata_version", "VARCHAR(64)"),
+]
+
+def addMissingColumns(app):
+    from sqlalchemy import inspect, text
+
+    with app.app_context():
+        inspector = inspect(db.engine)
+        for table, column, type in ADDED_COLUMNS:
+            if column not in [c["name"] for c in inspector.get_columns(table)]:
+                print("Add column '" + column + "' to table '" + table + "'.")
+                with db.engine.begin() as connection:
+                    connection.execute(text("ALTER TABLE \"" + table + "\" ADD COLUMN " + column + " " + type))
     
\ No newline at end of file
@@ -0,0 +1,96 @@
+import hashlib
+import mimetypes
+from datetime import datetime, timezone
+from os import path, listdir, stat
+
+from flask import send_file, abort, request
+
+
+# The files in "templates/img/", "templates/css/" and "templates/js/" are served with validators (ETag,
+# Last-Modified) and Cache-Control, so browsers download them only once and afterwards at most ask whether they
+# have changed, which is answered with "304 Not Modified" without sending the file again.
+# The hashes of the files are computed once when the app starts, so changed files need a restart of the app.
+# URLs containing the file's hash ("?v=<hash>", see asset_versions() in templates) are cached for a year without
+# asking again, the URL changes with the file.
+
+ASSET_ROOT = path.join(path.dirname(path.abspath(__file__)), "templates")
+
+ASSET_DIRS = ("img", "css", "js")
+
+# how long browsers may use a file without asking whether it has changed
+ASSET_MAX_AGE = 24 * 60 * 60
+
+# same for URLs containing the file's hash
+ASSET_IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+class Asset:
+    def __init__(self, file, etag, last_modified, mimetype):
+        self.file = file
+        self.etag = etag
+        self.last_modified = last_modified
+        self.mimetype = mimetype
+
+
+def fileHash(file):
+    sha256 = hashlib.sha256()
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()[:32]
+
+
+class AssetIndex:
+    def __init__(self, root=ASSET_ROOT, directories=ASSET_DIRS):
+        self.root = root
+        self.directories = directories
+        # (directory, filename) -> Asset
+        self._assets = {}
+
+    # computes hash, modification time and mime type of every file
+    def load(self):
+        assets = {}
+        for directory in self.directories:
+            folder = path.join(self.root, directory)
+            if not path.isdir(folder):
+                continue
+            for filename in listdir(folder):
+                file = path.join(folder, filename)
+                if not path.isfile(file):
+                    continue
+                mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+                last_modified = datetime.fromtimestamp(int(stat(file).st_mtime), timezone.utc)
+                assets[(directory, filename)] = Asset(file, fileHash(file), last_modified, mimetype)
+        self._assets = assets
+        return len(assets)
+
+    # only files found by load() can be requested, anything else (e.g. "../database.db") is unknown
+    def get(self, directory, filename):
+        return self._assets.get((directory, filename))
+
+    # hashes of all files of a directory as {filename: hash}, used by templates to build URLs containing them
+    def versions(self, directory):
+        return {filename: asset.etag for (d, filename), asset in self._assets.items() if d == directory}
+
+    # answers the request of a file, "304 Not Modified" if the browser already has the current version
+    def send(self, directory, filename):
+        asset = self.get(directory, filename)
+        if asset is None:
+            abort(404)
+
+        response = send_file(asset.file, mimetype=asset.mimetype, etag=asset.etag, last_modified=asset.last_modified,
+                             max_age=ASSET_MAX_AGE, conditional=True)
+
+        # the URL changes with the file, so this response never has to be checked again
+        if request.args.get("v") == asset.etag:
+            response.cache_control.max_age = ASSET_IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+        return response
+
+
+asset_index = AssetIndex()
+
+
+def init_app(app):
+    asset_index.load()
+    app.jinja_env.globals["asset_versions"] = asset_index.versions
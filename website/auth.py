@@ -1,12 +1,17 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash
+from flask import Blueprint, render_template, request, redirect, url_for, flash, has_request_context
 import pandas as pd
 from .models import User, Stop_h, Stop_w, State
 from . import db
 from flask_login import login_user, login_required, logout_user, current_user
-from os import path
-from .map import getHomeLoc, getWorkLoc
+from os import path, stat
+from .map import sigLocsFromStops
 import time
-from geopy.geocoders import Nominatim
+from os import cpu_count
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from .geocoding import getGeocoder
+from .mobilityreport import mobility_reports
+from .stopindex import stop_indexes
+from .metrics import span_duration
 import numpy as np
 from werkzeug.security import generate_password_hash, check_password_hash
 
@@ -51,8 +56,9 @@ def login():
 
     #sends log-in page to user
     if request.method =="GET":
-        #checks if database needs to be loaded, and does so
-        load_database()
+        #the database is loaded when the server starts (see create_app()) or by running precompute.py
+        if not databaseReady():
+            flash("The website is still being prepared. Please try again in a few minutes.", category="error")
         return render_template("login.html")
 
 @auth.route("/logout/")
@@ -102,81 +108,151 @@ def loaddb():
             return redirect(url_for("auth.login"))
 
     
-def load_database():
-    if(State.query.count()==0):
+# set as soon as users and significant locations are loaded, so the login page doesn't have to query State anymore
+database_ready = False
+
+
+def databaseReady():
+    global database_ready
+    if not database_ready:
+        state = State.query.first()
+        database_ready = state is not None and bool(state.db_loaded) and bool(state.sigLoc_loaded)
+    return database_ready
+
+
+#loads users and significant locations, if this hasn't happened yet
+def load_database(processes=None):
+    global database_ready
+    if database_ready:
+        return
+
+    state = State.query.first()
+    if state is None:
         state = State()
         state.db_loaded = False
         state.sigLoc_loaded = False
-                        
+
         db.session.add(state)
         db.session.commit()
-    
+
     #if db is empty
-    if State.query.first().db_loaded == False:
+    if not state.db_loaded:
         load_users()
-        State.query.first().db_loaded = True
+        state.db_loaded = True
         db.session.commit()
 
-
-    if State.query.first().sigLoc_loaded == False:
-        calculateSigLocs()
-        State.query.first().sigLoc_loaded = True
+    if not state.sigLoc_loaded:
+        calculateSigLocs(processes=processes)
+        state.sigLoc_loaded = True
         db.session.commit()
 
+    # parse the mobility reports and index the stops now, so "/map/" and "/api/visits/" don't have to
+    usernames = [user.username for user in User.query.all()]
+    mobility_reports.load(usernames)
+    stop_indexes.load(usernames)
+
+    database_ready = True
+
+
+# number of threads hashing new passwords
+HASH_WORKERS = 4
+
+
+# the version of the login data changes whenever the file is modified
+# it is checked for the whole file, not per user: if it hasn't changed since the last time, no password is checked,
+# otherwise the passwords of all existing users are checked (see load_users())
+def logindataVersion():
+    st = stat(LOG_IN_DATA_FILE)
+    return str(st.st_mtime_ns) + "-" + str(st.st_size)
+
+
+def hashPassword(password):
+    return generate_password_hash(password, method="sha256")
+
 
 #loads log-in data from LOG_IN_DATA_FILE (csv) in a local sqlanchemy database in order to work with flask-login
+#all users are loaded with a single query and written in a single transaction
 def load_users():
     #read data and put it in a dataframe (if it exists)
     if path.exists(LOG_IN_DATA_FILE):
+        start = time.time()
 
-        df = pd.read_csv(LOG_IN_DATA_FILE)
+        df = pd.read_csv(LOG_IN_DATA_FILE, dtype=str)
 
         print("Add users to database...", end="")
-        
+
+        #if a username appears more than once, the last password counts
+        passwords = dict(zip(df['username'], df['password']))
+
+        #all users already in database
+        existing_users = {user.username: user for user in User.query}
+
+        #passwords only have to be checked, if the file has changed since they have been checked the last time
+        state = State.query.first()
+        version = logindataVersion()
+        unchanged = state is not None and state.logindata_version == version
+
         #some variables to provide interesting information
         new = 0
         old = 0
         p = 0
 
-        for index, row in df.iterrows():
-            username_df = row['username']
+        new_usernames = []
+        for username_df, password in passwords.items():
+            existing_user = existing_users.get(username_df)
 
             #if user with same username is already in database, don't add them again
-            if User.query.filter_by(username=username_df).first():
-                old=old+1
-
-                #however, check if they have a new password and set it, if so
-                existing_user = User.query.filter_by(username=username_df).first()
-                
-                if not check_password_hash(existing_user.password, row['password']):
-                    existing_user.password = generate_password_hash(row['password'], method="sha256")
-                    db.session.commit()
-                    p=p+1
-                    
-            else:
-                #build new user
-                new_user = User()
-                new_user.username = username_df
-                new_user.password = generate_password_hash(row['password'], method="sha256")
-                new_user.sigLoc_loaded = False
-                new_user.survey_part1_answered = False
-                new_user.survey_part2_answered = False
-                
-                #add new user
-                db.session.add(new_user)
-                db.session.commit()
-                new = new+1
-                
-
+            if existing_user is None:
+                new_usernames.append(username_df)
+                continue
+
+            old=old+1
+
+            #unchanged file, nothing to do
+            if unchanged:
+                continue
+
+            #however, check if they have a new password and set it, if so
+            if not check_password_hash(existing_user.password, password):
+                existing_user.password = hashPassword(password)
+                p=p+1
+        checked = time.time()
+
+        #hash passwords of new users in parallel
+        with ThreadPoolExecutor(max_workers=HASH_WORKERS) as executor:
+            hashes = list(executor.map(hashPassword, [passwords[username] for username in new_usernames]))
+        hashed = time.time()
+
+        for username_df, password_hash in zip(new_usernames, hashes):
+            #build new user
+            new_user = User()
+            new_user.username = username_df
+            new_user.password = password_hash
+            new_user.sigLoc_loaded = False
+            new_user.survey_part1_answered = False
+            new_user.survey_part2_answered = False
+
+            #add new user
+            db.session.add(new_user)
+            new = new+1
+
+        if state is not None:
+            state.logindata_version = version
+        db.session.commit()
+        end = time.time()
 
         print("done.\n"+str(old)+" user(s) already in database. "+str(new)+" new user(s) added. ")
         print(str(p) +" password(s) have been updated.", end=" ")
 
         number_of_users = User.query.count()
         print(str(number_of_users)+" users in database.")
+        print("Took " + str(np.round(end - start, 2)) + " seconds (checking existing users: " + str(np.round(checked - start, 2))
+              + "s, hashing new passwords: " + str(np.round(hashed - checked, 2)) + "s, database: " + str(np.round(end - hashed, 2)) + "s).")
 
         if number_of_users == 0:
-                    flash("No users found in database.", category="error")
+                    #load_users() also runs while starting (see load_database()), without a request to flash to
+                    if has_request_context():
+                        flash("No users found in database.", category="error")
                     print("No users found in database!")
     else:
         print("No file "+ LOG_IN_DATA_FILE +" found!" , end="")
@@ -184,12 +260,16 @@ def load_users():
         print(str(number_of_users)+" users in database.")
     print("")
 
-def calculateSigLocs():
-    c = 0
+# calculates home and work locations of all users, whose significant locations haven't been calculated yet
+# the calculation is done in parallel by "processes" processes (default: number of cpus), the addresses are looked up
+# afterwards (see geocoding.py) and everything is written to the database in a single transaction
+def calculateSigLocs(geocoder=None, processes=None):
     print("Calculate significant locations...this might take a few seconds.")
     start = time.time()
-    geolocator = Nominatim(user_agent="LocTrace")
- 
+    if geocoder is None:
+        geocoder = getGeocoder()
+
+    users = []
     for user in User.query:
         stops_path = "data/" + user.username + "/stops.csv"
 
@@ -202,44 +282,72 @@ def calculateSigLocs():
         if user.sigLoc_loaded:
             continue
 
-        
+        users.append((user, stops_path))
 
-        stops = pd.read_csv(stops_path)
+    #calculate home and work locations of all users
+    sigLocs = {}
+    if processes is None:
+        processes = cpu_count() or 1
+    processes = min(processes, len(users))
 
-        #calculate home location
-        h_dic = getHomeLoc(stops)
-
-        #get adress
-        adress, coordinates = geolocator.reverse(str(h_dic["latitude"])+" "+str(h_dic["longitude"]))
+    if processes > 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = {executor.submit(sigLocsFromStops, stops_path): user for user, stops_path in users}
+            for future in as_completed(futures):
+                sigLocs[futures[future].id] = sigLocResult(futures[future], future)
+                printProgress(len(sigLocs), len(users), start)
+    else:
+        for user, stops_path in users:
+            try:
+                sigLocs[user.id] = sigLocsFromStops(stops_path)
+            except Exception as e:
+                print("Problem while calculating sigLocs of user "+ user.username + ": " + str(e))
+                sigLocs[user.id] = None
+            printProgress(len(sigLocs), len(users), start)
+    calculated = time.time()
+
+    #get adresses of all locations at once (cached and looked up concurrently, see geocoding.py)
+    coordinates = []
+    for user, _ in users:
+        if sigLocs[user.id] is not None:
+            home, work = sigLocs[user.id]
+            coordinates += [(entry["latitude"], entry["longitude"]) for entry in [home] + work]
+    adresses = iter(geocoder.reverse_many(coordinates))
+    geocoded = time.time()
+
+    #write everything in a single transaction
+    c = 0
+    for user, _ in users:
+        if sigLocs[user.id] is None:
+            continue
+        home, work = sigLocs[user.id]
 
-        #create Stop object
-        home = Stop_h(latitude = h_dic["latitude"], longitude = h_dic["longitude"],timestamp = h_dic["start"], adress = adress, user_id = user.id)
-        
-        #add to db and commit
-        db.session.add(home)
-        db.session.commit()
+        db.session.add(Stop_h(latitude = home["latitude"], longitude = home["longitude"], timestamp = home["start"], adress = next(adresses), user_id = user.id))
+        for entry in work:
+            db.session.add(Stop_w(latitude = entry["latitude"], longitude = entry["longitude"], timestamp = entry["start"], adress = next(adresses), user_id = user.id))
 
-        #calculate work location
-        w_list = getWorkLoc(stops, h_dic)
-        
-        #do the same as with the home lcoation
-        for entry in w_list:
-            
-            adress, coordinates = geolocator.reverse(str(entry["latitude"])+" "+str(entry["longitude"]))
-            work = Stop_w(latitude = entry["latitude"], longitude = entry["longitude"],timestamp = entry["start"], adress = adress, user_id= user.id)
-
-            db.session.add(work)
-            db.session.commit()
-        
-        if len(user.home) == 0 and len(user.home) == 0:
-            print("Problem while calculating sigLocs of user "+ user.username)
-        else:
-            c+=1
-            #mark that sigLocs have been calculated
-            user.sigLoc_loaded = True
-            db.session.commit()
+        #mark that sigLocs have been calculated
+        user.sigLoc_loaded = True
+        c+=1
+    db.session.commit()
 
     end = time.time()
-    print("...done. Calculated significant locations for "+ str(c)+ " user(s) in "+ str(np.round(end - start, 2))+" seconds.\n") 
+    print("...done. Calculated significant locations for "+ str(c)+ " user(s) in "+ str(np.round(end - start, 2))+" seconds "
+          + "(calculation: " + str(np.round(calculated - start, 2)) + "s, adresses: " + str(np.round(geocoded - calculated, 2))
+          + "s, database: " + str(np.round(end - geocoded, 2)) + "s).\n")
+
+    span_duration.observe(calculated - start, span="calculateSigLocs.calculate")
+    span_duration.observe(geocoded - calculated, span="calculateSigLocs.geocode")
+    span_duration.observe(end - geocoded, span="calculateSigLocs.database")
+
+
+def sigLocResult(user, future):
+    try:
+        return future.result()
+    except Exception as e:
+        print("Problem while calculating sigLocs of user "+ user.username + ": " + str(e))
+        return None
 
 
+def printProgress(done, total, start):
+    print("\t" + str(done) + "/" + str(total) + " user(s) done (" + str(np.round(time.time() - start, 2)) + "s)")
@@ -0,0 +1,57 @@
+from collections import OrderedDict
+import threading
+
+
+# thread-safe least-recently-used cache, bounded by the total size of its entries
+# the size of an entry is given when it is put into the cache (e.g. number of bytes), by default every entry has size 1
+class LRUCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, value, size=1):
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+
+            # entries bigger than the whole cache are not cached at all
+            if size > self.max_size:
+                return
+
+            self._entries[key] = (value, size)
+            self.size += size
+
+            # evict least recently used entries until the cache fits again
+            while self.size > self.max_size:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            value, size = self._entries.pop(key)
+            self.size -= size
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
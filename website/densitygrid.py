@@ -0,0 +1,249 @@
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from os import path, listdir, stat, replace, getpid, cpu_count
+
+import numpy as np
+import pandas as pd
+
+from .trackstore import track_store, DATA_DIR, TRACK_FILE
+
+
+# Where the whole cohort spends its time is aggregated once into a multi-resolution grid (run "python
+# compute_density.py" from the main directory), the admin view "/admin/density/" then only reads the cells it shows.
+# The grid follows the tiles of the map (web mercator): at zoom level z the world is 256 * 2^z pixels wide and every
+# cell is CELL_PIXELS x CELL_PIXELS pixels big, so cells look the same on every zoom level.
+# Only cells which aren't empty are stored, sorted by the tile they lie in (see cellKeys). A map never shows more
+# than MAX_VIEW_TILES tiles, so reading the cells of a view takes the same time, no matter how big the cohort is.
+
+DENSITY_FILE = "website/density_grid.npz"
+
+# increase this, if the format of the file changes
+DENSITY_FORMAT_VERSION = 1
+
+CELL_PIXELS = 4
+
+# cells per side of a tile, has to be a power of 2
+TILE_CELLS = 256 // CELL_PIXELS
+TILE_BITS = TILE_CELLS.bit_length() - 1
+
+# the levels 0 ... GRID_MAX_ZOOM are stored, maps zoomed in further show the cells of GRID_MAX_ZOOM
+# (at zoom 16 a cell is about 10m wide in Germany)
+GRID_MAX_ZOOM = 16
+
+# "samples": every gps sample counts 1, "stops": every stop counts its duration in hours
+DENSITY_WEIGHT = "samples"
+
+# tracks are read in chunks of this many samples (memory-mapped, see TrackStore.open)
+DENSITY_CHUNK_SAMPLES = 1000000
+
+# if a view needs more tiles than this, the cells of a lower zoom level are returned instead
+MAX_VIEW_TILES = 64
+
+# web mercator ends at these latitudes
+MAX_LATITUDE = 85.0511287798
+
+
+# returns the cells (x, y) of the coordinates at the given zoom level
+def cellCoordinates(latitude, longitude, zoom):
+    lat = np.radians(np.clip(np.asarray(latitude, dtype=np.float64), -MAX_LATITUDE, MAX_LATITUDE))
+    lon = np.clip(np.asarray(longitude, dtype=np.float64), -180, 180)
+    cells = TILE_CELLS * 2**zoom
+
+    x = (lon + 180) / 360 * cells
+    y = (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2 * cells
+    return (np.clip(np.floor(x), 0, cells - 1).astype(np.int64),
+            np.clip(np.floor(y), 0, cells - 1).astype(np.int64))
+
+
+# returns the coordinates of the cells' centers
+def cellCenters(x, y, zoom):
+    cells = TILE_CELLS * 2**zoom
+    longitude = (x + 0.5) / cells * 360 - 180
+    latitude = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + 0.5) / cells))))
+    return latitude, longitude
+
+
+# the key of a cell starts with the index of its tile, so all cells of a tile (and of a column of tiles) are stored
+# next to each other: tile_x * 2^zoom + tile_y, then the cell's x and y within the tile
+def cellKeys(x, y, zoom):
+    tile = (x >> TILE_BITS) * 2**zoom + (y >> TILE_BITS)
+    return (tile << 2 * TILE_BITS) | ((x & (TILE_CELLS - 1)) << TILE_BITS) | (y & (TILE_CELLS - 1))
+
+
+def keyCells(keys, zoom):
+    tile = keys >> 2 * TILE_BITS
+    x = ((tile // 2**zoom) << TILE_BITS) | ((keys >> TILE_BITS) & (TILE_CELLS - 1))
+    y = ((tile % 2**zoom) << TILE_BITS) | (keys & (TILE_CELLS - 1))
+    return x, y
+
+
+# sums the weights of equal keys, returns the sorted keys and their sums
+def aggregate(keys, weights):
+    keys, inverse = np.unique(keys, return_inverse=True)
+    return keys, np.bincount(inverse.ravel(), weights=weights, minlength=len(keys))
+
+
+# returns the keys and weights of all cells of a user at GRID_MAX_ZOOM
+def userDensity(username, weight=DENSITY_WEIGHT):
+    if weight == "stops":
+        stops = pd.read_csv(path.join(DATA_DIR, username, "stops.csv"), usecols=["latitude", "longitude", "duration"])
+        parts = [(stops["latitude"].to_numpy(), stops["longitude"].to_numpy(), stops["duration"].to_numpy() / 3600)]
+    else:
+        track = track_store.open(username)
+        parts = ((track.latitude[start:start + DENSITY_CHUNK_SAMPLES], track.longitude[start:start + DENSITY_CHUNK_SAMPLES], None)
+                 for start in range(0, len(track), DENSITY_CHUNK_SAMPLES))
+
+    keys, weights = [], []
+    for latitude, longitude, values in parts:
+        latitude = np.asarray(latitude, dtype=np.float64)
+        longitude = np.asarray(longitude, dtype=np.float64)
+        values = np.ones(len(latitude)) if values is None else np.asarray(values, dtype=np.float64)
+        valid = ~(np.isnan(latitude) | np.isnan(longitude) | np.isnan(values))
+
+        chunk_keys, chunk_weights = aggregate(cellKeys(*cellCoordinates(latitude[valid], longitude[valid], GRID_MAX_ZOOM), GRID_MAX_ZOOM),
+                                              values[valid])
+        keys.append(chunk_keys)
+        weights.append(chunk_weights)
+
+    if not keys:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    return aggregate(np.concatenate(keys), np.concatenate(weights))
+
+
+# the density of the whole cohort
+# levels: {zoom: (keys, weights)} for every zoom level 0 ... GRID_MAX_ZOOM, keys are sorted (see cellKeys)
+# center: weighted mean of all cells, the admin view is opened there
+class DensityGrid:
+    def __init__(self, levels, weight, users, created, center, version=None):
+        self.levels = levels
+        self.weight = weight
+        self.users = users
+        self.created = created
+        self.center = center
+        self.version = version
+
+    # builds all levels from the cells of GRID_MAX_ZOOM, every level's cell holds 2x2 cells of the next level
+    @staticmethod
+    def fromCells(keys, weights, weight, users):
+        levels = {GRID_MAX_ZOOM: (keys.astype(np.int64), weights.astype(np.float32))}
+        for zoom in range(GRID_MAX_ZOOM - 1, -1, -1):
+            x, y = keyCells(levels[zoom + 1][0], zoom + 1)
+            keys, sums = aggregate(cellKeys(x >> 1, y >> 1, zoom), levels[zoom + 1][1].astype(np.float64))
+            levels[zoom] = (keys, sums.astype(np.float32))
+
+        center = (0.0, 0.0)
+        finest = levels[GRID_MAX_ZOOM]
+        if len(finest[0]) > 0 and finest[1].sum() > 0:
+            latitude, longitude = cellCenters(*keyCells(finest[0], GRID_MAX_ZOOM), GRID_MAX_ZOOM)
+            center = (float(np.average(latitude, weights=finest[1])), float(np.average(longitude, weights=finest[1])))
+
+        return DensityGrid(levels, weight, users, time.strftime("%Y-%m-%d %H:%M:%S"), center)
+
+    # writes the grid into a single .npz file (a temporary file first, so a half-written grid is never read)
+    def save(self, file=DENSITY_FILE):
+        arrays = {"format": np.array(DENSITY_FORMAT_VERSION), "weight": np.array(self.weight), "users": np.array(self.users),
+                  "created": np.array(self.created), "center": np.array(self.center)}
+        for zoom, (keys, weights) in self.levels.items():
+            arrays["keys" + str(zoom)] = keys
+            arrays["weights" + str(zoom)] = weights
+
+        tmp = file + ".tmp-" + str(getpid())
+        with open(tmp, "wb") as f:
+            np.savez(f, **arrays)
+        replace(tmp, file)
+
+    @staticmethod
+    def load(file=DENSITY_FILE, version=None):
+        with np.load(file) as data:
+            if int(data["format"]) != DENSITY_FORMAT_VERSION:
+                raise ValueError("The density grid has an old format, run compute_density.py again.")
+            levels = {zoom: (data["keys" + str(zoom)], data["weights" + str(zoom)]) for zoom in range(GRID_MAX_ZOOM + 1)}
+            return DensityGrid(levels, str(data["weight"]), int(data["users"]), str(data["created"]),
+                               tuple(float(v) for v in data["center"]), version)
+
+    # returns the cells of the given zoom level within the bounds as arrays of latitude, longitude (the cells' centers)
+    # and weight, whole tiles are returned. the zoom level actually used is returned as well: at most GRID_MAX_ZOOM and
+    # low enough for the bounds to need at most MAX_VIEW_TILES tiles
+    def cells(self, zoom, south, west, north, east):
+        zoom = int(min(max(zoom, 0), GRID_MAX_ZOOM))
+        while True:
+            x0, y0 = cellCoordinates(north, west, zoom)
+            x1, y1 = cellCoordinates(south, east, zoom)
+            tiles_x = range(int(x0) >> TILE_BITS, (int(x1) >> TILE_BITS) + 1)
+            tiles_y = (int(y0) >> TILE_BITS, int(y1) >> TILE_BITS)
+            if len(tiles_x) * (tiles_y[1] - tiles_y[0] + 1) <= MAX_VIEW_TILES or zoom == 0:
+                break
+            zoom -= 1
+
+        # the tiles of a column are stored next to each other, so every column is a single slice
+        keys, weights = self.levels[zoom]
+        slices = []
+        for tile_x in tiles_x:
+            first = np.searchsorted(keys, (tile_x * 2**zoom + tiles_y[0]) << 2 * TILE_BITS)
+            last = np.searchsorted(keys, (tile_x * 2**zoom + tiles_y[1] + 1) << 2 * TILE_BITS)
+            slices.append(slice(first, last))
+
+        view_keys = np.concatenate([keys[s] for s in slices]) if slices else keys[:0]
+        view_weights = np.concatenate([weights[s] for s in slices]) if slices else weights[:0]
+        latitude, longitude = cellCenters(*keyCells(view_keys, zoom), zoom)
+        return zoom, latitude, longitude, view_weights
+
+
+# returns the users with a track in the data directory
+def cohortUsers(data_dir=DATA_DIR):
+    return sorted(u for u in listdir(data_dir) if path.exists(path.join(data_dir, u, TRACK_FILE)))
+
+
+# bins the samples (or stops) of all users into the grid, in parallel by "processes" processes (default: number of cpus)
+def computeDensityGrid(usernames, weight=DENSITY_WEIGHT, processes=None):
+    start = time.time()
+    if processes is None:
+        processes = cpu_count() or 1
+    processes = max(min(processes, len(usernames)), 1)
+
+    keys, weights = [], []
+
+    def add(username, result):
+        keys.append(result[0])
+        weights.append(result[1])
+        print("\t" + str(len(keys)) + "/" + str(len(usernames)) + " user(s) done (" + username + ", "
+              + str(np.round(time.time() - start, 2)) + "s)")
+
+    if processes > 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = {executor.submit(userDensity, username, weight): username for username in usernames}
+            for future in as_completed(futures):
+                add(futures[future], future.result())
+    else:
+        for username in usernames:
+            add(username, userDensity(username, weight))
+
+    if keys:
+        cohort_keys, cohort_weights = aggregate(np.concatenate(keys), np.concatenate(weights))
+    else:
+        cohort_keys, cohort_weights = np.zeros(0, dtype=np.int64), np.zeros(0)
+    return DensityGrid.fromCells(cohort_keys, cohort_weights, weight, len(usernames))
+
+
+# keeps the grid in memory and loads it again, whenever the file changes
+class DensityGridStore:
+    def __init__(self, file=DENSITY_FILE):
+        self.file = file
+        self._grid = None
+
+    # returns the DensityGrid, None if it hasn't been computed yet
+    def get(self):
+        try:
+            st = stat(self.file)
+        except FileNotFoundError:
+            return None
+        version = str(st.st_mtime_ns) + "-" + str(st.st_size)
+
+        grid = self._grid
+        if grid is None or grid.version != version:
+            grid = DensityGrid.load(self.file, version)
+            self._grid = grid
+        return grid
+
+
+density_grids = DensityGridStore()
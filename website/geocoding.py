@@ -0,0 +1,168 @@
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .metrics import registry, span
+
+
+# Reverse geocoding (coordinates -> address) of significant locations.
+# Every address is saved in a sqlite database (GEOCODE_CACHE_DB), so the same coordinates are only looked up once,
+# even if the database is reloaded ("/loaddb/") or the server is restarted. Coordinates are rounded to
+# GEOCODE_PRECISION decimals for the lookup (5 decimals are about 1m).
+# Lookups, which are not cached yet, are sent by GEOCODE_WORKERS threads at the same time, but never more than
+# GEOCODE_RATE_LIMIT per second. The public Nominatim server allows at most 1 request per second, a higher limit
+# only makes sense with an own Nominatim server.
+
+GEOCODE_CACHE_DB = "website/geocache.db"
+
+GEOCODE_PRECISION = 5
+
+GEOCODE_RATE_LIMIT = 1.0
+
+GEOCODE_WORKERS = 4
+
+geocode_lookups = registry.counter("loctrace_geocode_lookups_total", "Addresses requested by result (cached, found, failed).")
+
+
+# looks up addresses with geopy's Nominatim (OpenStreetMap)
+class NominatimBackend:
+    def __init__(self, user_agent="LocTrace", domain=None):
+        from geopy.geocoders import Nominatim
+
+        if domain:
+            self.geolocator = Nominatim(user_agent=user_agent, domain=domain)
+        else:
+            self.geolocator = Nominatim(user_agent=user_agent)
+
+    # returns the address or None, if there is none
+    def reverse(self, latitude, longitude):
+        location = self.geolocator.reverse(str(latitude) + " " + str(longitude))
+        if location is None:
+            return None
+        return location.address
+
+
+# local stand-in for Nominatim (for tests and benchmarks), the "address" are the coordinates
+# delay simulates the time a real lookup takes
+class StaticBackend:
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.requests = 0
+
+    def reverse(self, latitude, longitude):
+        self.requests += 1
+        if self.delay:
+            time.sleep(self.delay)
+        return "%.5f, %.5f" % (latitude, longitude)
+
+
+# makes sure calls to wait() return at most "rate" times per second, across all threads
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+# persistent cache of addresses, key are the rounded coordinates
+class GeocodeCache:
+    def __init__(self, db_path=GEOCODE_CACHE_DB):
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS reverse_geocode ("
+                                     "latitude REAL NOT NULL, longitude REAL NOT NULL, adress TEXT, "
+                                     "PRIMARY KEY (latitude, longitude))")
+
+    # returns a dictionary {key: adress} of all cached keys
+    def get_many(self, keys):
+        found = {}
+        with self._lock:
+            for key in keys:
+                row = self._connection.execute("SELECT adress FROM reverse_geocode WHERE latitude = ? AND longitude = ?",
+                                               key).fetchone()
+                if row is not None:
+                    found[key] = row[0]
+        return found
+
+    def put_many(self, entries):
+        with self._lock, self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO reverse_geocode (latitude, longitude, adress) VALUES (?, ?, ?)",
+                                         [(key[0], key[1], adress) for key, adress in entries.items()])
+
+
+class Geocoder:
+    def __init__(self, backend=None, cache=None, precision=GEOCODE_PRECISION, rate_limit=GEOCODE_RATE_LIMIT,
+                 workers=GEOCODE_WORKERS):
+        self.backend = backend if backend is not None else NominatimBackend()
+        self.cache = cache if cache is not None else GeocodeCache()
+        self.precision = precision
+        self.workers = workers
+        self._rate_limiter = RateLimiter(rate_limit)
+
+    def key(self, latitude, longitude):
+        return (round(float(latitude), self.precision), round(float(longitude), self.precision))
+
+    def reverse(self, latitude, longitude):
+        return self.reverse_many([(latitude, longitude)])[0]
+
+    # returns the addresses of all coordinates [(latitude, longitude), ...] in the same order
+    # addresses which couldn't be looked up are None (and are not cached, so they are tried again next time)
+    def reverse_many(self, coordinates):
+        keys = [self.key(lat, lon) for lat, lon in coordinates]
+
+        with span("geocode.cache"):
+            addresses = self.cache.get_many(set(keys))
+        missing = [key for key in set(keys) if key not in addresses]
+        geocode_lookups.inc(len(addresses), result="cached")
+
+        if missing:
+            print("Looking up " + str(len(missing)) + " address(es), " + str(len(addresses)) + " cached.")
+            with span("geocode.lookup"), ThreadPoolExecutor(max_workers=self.workers) as executor:
+                results = dict(zip(missing, executor.map(self._lookup, missing)))
+
+            found = {key: adress for key, adress in results.items() if adress is not None}
+            geocode_lookups.inc(len(found), result="found")
+            geocode_lookups.inc(len(results) - len(found), result="failed")
+
+            self.cache.put_many(found)
+            addresses.update(results)
+
+        return [addresses.get(key) for key in keys]
+
+    def _lookup(self, key):
+        self._rate_limiter.wait()
+        try:
+            return self.backend.reverse(key[0], key[1])
+        except Exception as e:
+            print("Couldn't look up address of " + str(key) + ": " + str(e))
+            return None
+
+
+_geocoder = None
+_geocoder_lock = threading.Lock()
+
+
+# returns the geocoder used by the app (created on first use)
+def getGeocoder():
+    global _geocoder
+    with _geocoder_lock:
+        if _geocoder is None:
+            _geocoder = Geocoder()
+        return _geocoder
+
+
+# replaces the geocoder used by the app, e.g. with Geocoder(StaticBackend()) for tests
+def setGeocoder(geocoder):
+    global _geocoder
+    with _geocoder_lock:
+        _geocoder = geocoder
@@ -7,116 +7,204 @@ import folium
 import pandas as pd
 import branca.colormap as cm
 from datetime import datetime
-from datetime import timedelta
+from zoneinfo import ZoneInfo
+from types import SimpleNamespace
 import numpy as np
-from os import path, mkdir, listdir, remove
+from .trackstore import track_store
+from .mobilityreport import mobility_reports
+from .metrics import span
+from .cache import LRUCache
 
 
-# loading all the loc data
-# using panda dataframe
+# "binned": the track is drawn as one multi-polyline per color bin (fast, small html files)
+# "segments": the track is drawn as one polyline per pair of samples (old behaviour, slow for big tracks)
+TRACK_RENDER_MODE = "binned"
 
-def filter_by_date_range(start_date, start_time, end_date, end_time):
-    start_date = datetime.datetime.strptime(start_date, "%Y-%m-%d")
-    start_time = datetime.datetime.strptime(start_time, "%H:%M")
-    end_date = datetime.datetime.strptime(end_date, "%Y-%m-%d")
-    end_time = datetime.datetime.strptime(end_time, "%H:%M")
+# number of bins every step of the colormap is split into when drawing binned tracks
+# with 16 bins per step the drawn colors differ by only a few shades from the continuous colormap
+COLOR_BINS_PER_STEP = 16
 
-    start_datetime = datetime.datetime.combine(start_date, start_time.time())
-    end_datetime = datetime.datetime.combine(end_date, end_time.time())
+# zoom level the map is opened with
+ZOOM_START = 10
 
-    data = pd.read_csv("website/data/example_gps.csv")
-    #df_filtered = pd.DataFrame(columns=['Unnamed: 0', 'ts', 'longitude', 'latitude', 'altitude', 'accuracy', 'motion_score', 'y', 'x'])
+# before drawing, tracks are simplified (Douglas-Peucker), points that wouldn't be visible on screen are left out
+# SIMPLIFY_ZOOM is the most detailed zoom level at which the simplified track should look like the original one,
+# SIMPLIFY_PIXELS the maximum distance (in pixels at that zoom level) between the simplified and the original track
+SIMPLIFY_TRACKS = True
+SIMPLIFY_ZOOM = 15
+SIMPLIFY_PIXELS = 1.0
 
-    data['ts'] = data['ts'].apply(
-        lambda x: datetime.datetime.strptime(x, "%Y-%m-%d %H:%M:%S+02:00"))
-    data_filtered = data[start_datetime <= data['ts']]
-    data_filtered2 = data_filtered[data['ts'] <= end_datetime]
+# tracks with more samples than STREAMING_MIN_SAMPLES are drawn by buildmap in chunks of STREAM_CHUNK_SAMPLES samples,
+# which are read memory-mapped from the binary track cache (see TrackStore.open), so only one chunk at a time has to be
+# in memory, no matter how big the track is. Every chunk is simplified on its own
+STREAMING_MIN_SAMPLES = 2000000
+STREAM_CHUNK_SAMPLES = 250000
 
-    return data_filtered2
+# if set, every stay at a stop (consecutive samples with the same stop_id, see convert.py) is drawn as a single marker,
+# which shows when and how long the stop was visited, only the trips between the stops are drawn as lines
+# tracks without stop_id (the column is missing in csv files which weren't converted by convert.py) are drawn as before
+COLLAPSE_STOPS = False
 
-# functions for calculation home and work location
+# radius (in pixels) of the markers of stays shorter than an hour, the radius grows with the duration up to STAY_MAX_RADIUS
+STAY_MIN_RADIUS = 4
+STAY_MAX_RADIUS = 12
 
-# converts a str to a date
+# increase this whenever the way maps are built changes, so cached maps (see rendercache.py) are rendered again
+RENDER_VERSION = 2
 
+# simplified tracks (as masks of the samples to keep) of the most recently drawn tracks
+simplification_cache = LRUCache(64 * 1024 * 1024)
 
-def toDate(str):
-    return datetime.strptime(str[0:-6], "%Y-%m-%d %H:%M:%S")
 
+# the participants' timezone, dates and times entered in the filter are interpreted as local times of this zone
+TIMEZONE = ZoneInfo("Europe/Berlin")
 
-# returns location of home
-def getHomeLoc(stops):
 
-    durationPerUniqueId = np.zeros(len(stops), dtype=np.int64)
+# converts a local date ("2022-04-01") and time ("13:45") into seconds since epoch (UTC)
+def localToEpoch(date, time):
+    return int(datetime.strptime(date + " " + time, "%Y-%m-%d %H:%M").replace(tzinfo=TIMEZONE).timestamp())
 
-    for i in range(0, len(stops)):
-        durationPerUniqueId[stops.iloc[i]["unique_id"]] += stops.iloc[i]["duration"]
 
-    max_index = np.argmax(durationPerUniqueId)
-    #print("max: "+str(max_index))
-    longest_visited_place = None
+# checks the dates ("2022-04-01") and times ("13:45") of the filter form, empty fields are allowed (see filter_by_date_range)
+def validFilter(start_date, end_date, start_time, end_time):
+    try:
+        for value in (start_date, end_date):
+            if value:
+                datetime.strptime(value, "%Y-%m-%d")
+        for value in (start_time, end_time):
+            if value:
+                datetime.strptime(value, "%H:%M")
+    except ValueError:
+        return False
+    return True
+
+
+# returns the user's samples between the given dates and times (as sent by the filter form in map.html) as a view on the track
+# a missing start/end date means the first/last sample, a missing time means the start/end of the day
+# the end is inclusive, "13:45" includes all samples up to 13:45:59
+# the track is memory-mapped and only the rows of the days within the range are read (see DayManifest.rows)
+def filter_by_date_range(username, start_date, start_time, end_date, end_time):
+    track = track_store.open(username)
+
+    if len(track) == 0:
+        return track
+
+    if start_date:
+        start = localToEpoch(start_date, start_time or "00:00")
+    else:
+        start = track.ts[0]
+
+    if end_date:
+        end = localToEpoch(end_date, end_time or "23:59") + 59
+    else:
+        end = track.ts[-1]
+
+    first, last = track_store.days(username).rows(start, end)
+    return track[first:last].between(start, end)
+
+# functions for calculation home and work location
+
+# converts a str to a date
 
-    for i in range(0, len(stops)):
-        if stops.iloc[i]["unique_id"] == max_index:
-            longest_visited_place = stops.iloc[i]
-            break
-    return longest_visited_place
 
+def toDate(str):
+    return datetime.strptime(str[0:-6], "%Y-%m-%d %H:%M:%S")
 
-def diff_id(loc1, loc2):
-    if loc2 is None:
-        return True
-    if loc1["unique_id"] != loc2["unique_id"]:
-        return True
-    return False
 
+# parses the "start" column of stops like toDate() (the utc offset is ignored)
+# returns the day (days since epoch) and weekday (0 = monday) of every stop
+def stopDays(stops):
+    dates = pd.to_datetime(stops["start"].astype(str).str[0:-6], format="%Y-%m-%d %H:%M:%S")
+    days = dates.values.astype("datetime64[D]").astype(np.int64)
+    # 1970-01-01 was a thursday
+    weekdays = (days + 3) % 7
+    return days, weekdays
+
+
+# durations of stops as they were summed up before (adding floats to an int64 array truncates them)
+def stopDurations(stops):
+    return np.trunc(stops["duration"].to_numpy(dtype=np.float64))
+
+
+# returns the unique_id with the biggest total duration, like np.argmax over an array indexed by unique_id
+# (ties go to the smallest unique_id, 0 if no duration is bigger than 0)
+def argmaxUniqueId(unique_ids, durations):
+    if len(unique_ids) == 0:
+        return 0
+    ids, inverse = np.unique(unique_ids, return_inverse=True)
+    totals = np.bincount(inverse, weights=durations, minlength=len(ids))
+    if totals.max() <= 0:
+        return 0
+    return ids[np.argmax(totals)]
+
+
+# marks the stops, which start a new day
+# the day is a counter, which starts at the date of the first stop and is increased by one day for every stop with a
+# different date. if days without stops are skipped, the counter lags behind, so the following stops start new days
+# until it has caught up (this is how the original loops worked, it is kept, so results don't change)
+def newDayMask(days):
+    n = len(days)
+    if n == 0:
+        return np.zeros(0, dtype=bool)
+
+    if np.all(np.diff(days) >= 0):
+        # for sorted days, the counter after stop i is min(days[i], counter before + 1) = i + min(days[j] - j, j <= i)
+        idx = np.arange(n)
+        counter = idx + np.minimum.accumulate(days - idx)
+        before = np.concatenate(([days[0]], counter[:-1]))
+        return days != before
+
+    mask = np.zeros(n, dtype=bool)
+    counter = days[0]
+    for i in range(0, n):
+        if days[i] != counter:
+            mask[i] = True
+            counter += 1
+    return mask
+
+
+# returns location of home (the first stop of the place with the longest total duration)
+def getHomeLoc(stops):
+    unique_ids = stops["unique_id"].to_numpy()
 
-def getDate(data):
-    return toDate(data["start"])
+    # np.argmax over durations per unique_id (np.bincount is a groupby-sum)
+    durationPerUniqueId = np.bincount(unique_ids, weights=stopDurations(stops), minlength=len(stops))
+    max_index = np.argmax(durationPerUniqueId)
 
-# gets a pandas dataframe
-# gives longest visited place
+    first = np.flatnonzero(unique_ids == max_index)
+    if len(first) == 0:
+        return None
+    return stops.iloc[first[0]]
 
 
 # returns an array of possible work locations
 def getWorkLoc(stops, home):
+    unique_ids = stops["unique_id"].to_numpy()
+    durations = stopDurations(stops)
+    days, weekdays = stopDays(stops)
+    home_id = None if home is None else home["unique_id"]
 
-    durationPerUniqueId = np.zeros(len(stops), dtype=np.int64)
-
-    # add all durations sorted after unique_id (if it is not home's id)
-    for i in range(0, len(stops)):
+    # add all durations sorted after unique_id (if it is not home's id and on a weekday)
+    counted = weekdays < 5
+    if home_id is not None:
+        counted &= unique_ids != home_id
+    durationPerUniqueId = np.bincount(unique_ids[counted], weights=durations[counted], minlength=len(stops))
 
-        if diff_id(stops.iloc[i], home) and toDate(stops["start"].iloc[i]).weekday() < 5:
-            #print("weekday: "+str(toDate(stops.iloc[i]["start"]).weekday()))
-            durationPerUniqueId[stops.iloc[i]["unique_id"]] += stops.iloc[i]["duration"]
     # get index (= unique_id) of biggest entry
     max_index = np.argmax(durationPerUniqueId)
 
+    # find first entry calculated unique_id and take it as work location
     workplace = []
+    first = np.flatnonzero(unique_ids == max_index)
+    if len(first) > 0:
+        workplace.append(stops.iloc[first[0]])
 
-    # find first entry calculated unique_id and take it as work location
-    for i in range(0, len(stops)):
-        if stops.iloc[i]["unique_id"] == max_index:
-            workplace.append(stops.iloc[i])
-            break
     # get total time at work in hours
     time_worked = durationPerUniqueId[max_index]/(60*60)
 
-    number_workdays = 0
-
-    # calculate the number of work days
-    # (not a nice way to do it this way, but since we're only working with relativly small data it should be fine)
-    curr1 = getDate(stops.iloc[0])
-
-    for i in range(0, len(stops)):
-        # if stops.iloc[i] has different date than curr1
-        if (getDate(stops.iloc[i]).date() - curr1.date()) != timedelta(days=0):
-
-            # if this is a workday
-            if getDate(stops.iloc[i]).weekday() < 5:
-                number_workdays += 1
-
-            # set curr to the next day
-            curr1 = curr1 + timedelta(days=1)
+    # calculate the number of work days (the stops starting a new day on a weekday, see newDayMask())
+    new_day = newDayMask(days)
+    number_workdays = np.count_nonzero(new_day & (weekdays < 5))
 
     # to prevent errors
     if number_workdays == 0:
@@ -127,58 +215,62 @@ def getWorkLoc(stops, home):
 
     # (2*8) / 5 = 3.2 ->two days fulltime work at the same place will not trigger this yet
     if avr_work < 3:
+        workplace = workplacesPerDay(stops, unique_ids, durations, weekdays, new_day, home_id)
+
+    return workplace
+
+
+# returns the place (except home) with the longest duration of every workday, used if no single place of work is found
+# every day is a list of stops, which starts with a stop of that day and holds the following stops of the same day.
+# the original loops reused their loop variable, so after a workday the next day doesn't start with its own first stop,
+# but with the stop at the position (within the whole table) the search for the place of work stopped at within the day.
+# this is kept, so results don't change
+def workplacesPerDay(stops, unique_ids, durations, weekdays, new_day, home_id):
+    workplace = []
 
-        workplace = []
-        curr2 = getDate(stops.iloc[0])
-        temp = []
-        max_index = None
-
-        # go over all stops
-        for i in range(0, len(stops)):
-            # if stops.iloc[i] has different date than curr2
-            if (getDate(stops.iloc[i]).date() - curr2.date()) != timedelta(days=0):
-
-                # if this is a workday
-                if len(temp) > 0 and getDate(temp[0]).weekday() < 5:
-                    durationPerUniqueId = np.zeros(
-                        len(stops)-1, dtype=np.int64)
-
-                    # go over entries in temp
-                    for i in range(0, len(temp)):
-                        # if it's not the calculated home
-                        if diff_id(temp[i], home):
-                            # add on index ["unique_id"] to durationPerUniqueId[]
-                            durationPerUniqueId[temp[i]
-                                                ["unique_id"]] += temp[i]["duration"]
-
-                    # get index (->"unique_id") of biggest number
-                    max_index = np.argmax(durationPerUniqueId)
-
-                    # get first element in temp with said unique_id
-                    for i in range(0, len(temp)):
-
-                        # np.argmax can STILL return home["unique_id"], if the biggest values in durationPerUniqueId are
-                        # the same - if all values are 0, than 0 (as the first occurence) will be returned
-                        # this means we still need to filter home["unique_id"] out!
-                        if max_index != home["unique_id"] and temp[i]["unique_id"] == max_index:
-
-                            # add to other calculated places of work, reset max_index
-                            workplace.append(temp[i])
-                            max_index = None
-                            break
-
-                # set curr2 to the next day and reset temp
-                curr2 = curr2 + timedelta(days=1)
-                temp = []
-                temp.append(stops.iloc[i])
-
-            # if same day
+    # stops at which a new day starts, the last day is never evaluated
+    boundaries = np.flatnonzero(new_day)
+    first = 0
+    day_start = 0
+
+    for boundary in boundaries:
+        # the stops of the day: its first stop followed by all stops up to the next day
+        day = np.concatenate(([first], np.arange(day_start + 1, boundary)))
+        first = boundary
+
+        # if this is a workday
+        if weekdays[day[0]] < 5:
+            ids = unique_ids[day]
+            not_home = ids != home_id if home_id is not None else np.ones(len(day), dtype=bool)
+            max_index = argmaxUniqueId(ids[not_home], durations[day][not_home])
+
+            # np.argmax can STILL return home["unique_id"], if the biggest values are the same - if all values are 0,
+            # than 0 (as the first occurence) will be returned. this means we still need to filter home["unique_id"] out!
+            matches = np.flatnonzero(ids == max_index)
+            if max_index != home_id and len(matches) > 0:
+                workplace.append(stops.iloc[day[matches[0]]])
+                first = matches[0]
             else:
-                temp.append(stops.iloc[i])
+                first = len(day) - 1
+
+        day_start = boundary
 
     return workplace
 
 
+# calculates home and work locations of the stops in the given file (stops.csv)
+# returns plain dictionaries (latitude, longitude, start), so this can be run in other processes (see calculateSigLocs)
+def sigLocsFromStops(stops_path):
+    stops = pd.read_csv(stops_path)
+
+    def entry(stop):
+        return {"latitude": float(stop["latitude"]), "longitude": float(stop["longitude"]), "start": str(stop["start"])}
+
+    home = getHomeLoc(stops)
+    work = getWorkLoc(stops, home)
+    return entry(home), [entry(w) for w in work]
+
+
 # builds a little popup
 def buildPopup(entry, showLastVisit):
 
@@ -212,22 +304,28 @@ def addSigificantLocations(user, map):
         folium.Marker((entry.latitude, entry.longitude), icon=folium.Icon(
             icon='wrench', color='red'), popup=popup_w).add_to(map)
 
-def saveMap(map, filenumber):
-    dir = 'website/templates/iframes/'
+# copies everything needed for building a map from the user (including home and work) into plain objects
+# maps are built in background threads (see renderpool.py), where the database session of the request can't be used
+def snapshotUser(user):
+    def copyStop(stop):
+        return SimpleNamespace(id=stop.id, latitude=stop.latitude, longitude=stop.longitude,
+                               timestamp=stop.timestamp, adress=stop.adress)
+
+    return SimpleNamespace(id=user.id, username=user.username,
+                           home=[copyStop(h) for h in user.home], work=[copyStop(w) for w in user.work])
 
-    #check if directory exists and create one, if it doesn't
-    if not path.exists(dir):
-        mkdir(dir)
-    
-    #delete other file(s) to prevent memory overflow
-    for f in listdir(dir):
-        remove(path.join(dir, f))
 
-    #save file
-    map.save(dir+"map"+str(filenumber)+'.html')
+# everything a rendered map depends on besides the filter, used to build the key of the map cache (see rendercache.py)
+# if this changes (new data, new significant locations, different rendering), the map is rendered again
+def mapVersion(user):
+    home = [(h.id, h.latitude, h.longitude, h.timestamp, h.adress) for h in user.home]
+    work = [(w.id, w.latitude, w.longitude, w.timestamp, w.adress) for w in user.work]
+    settings = [RENDER_VERSION, TRACK_RENDER_MODE, COLOR_BINS_PER_STEP, ZOOM_START, SIMPLIFY_TRACKS, SIMPLIFY_ZOOM, SIMPLIFY_PIXELS,
+                STREAMING_MIN_SAMPLES, STREAM_CHUNK_SAMPLES, COLLAPSE_STOPS, STAY_MIN_RADIUS, STAY_MAX_RADIUS]
+    return [settings, track_store.version(user.username), home, work]
 
-# function for building the map with given data
-def buildmap(user, filenumber):
+# function for building the map with given data, returns the folium map
+def buildmap(user):
     '''
     userStr = str(user)[1:-1].replace(" ","")
     #print(str(user))
@@ -236,161 +334,524 @@ def buildmap(user, filenumber):
     print("username: " +  user.username)
     '''
 
-    csv_path = "data/" + user.username + "/gps_samples_and_motion_score.csv"
+    # very large tracks are drawn chunk by chunk, without loading them into memory
+    if TRACK_RENDER_MODE == "binned" and len(track_store.open(user.username)) > STREAMING_MIN_SAMPLES:
+        return buildStreamingMap(user)
 
-    data = pd.read_csv(csv_path)
+    with span("buildmap.track"):
+        data = track_store.get(user.username)
 
-    location = data['latitude'].mean(), data['longitude'].mean()
+    # the mean of all samples is saved in the track's day manifest (see trackstore.py)
+    location = track_store.days(user.username).center()
 
     map = folium.Map(
         location,
-        zoom_start=10)
+        zoom_start=ZOOM_START)
 
-    colormap = cm.LinearColormap(colors=['darkblue', 'blue', 'green', 'yellow', 'orange', 'red'],
-                                     index=[0, 50, 100, 200, 600, 1000], vmin=0, vmax=1000,
-                                     caption='motion score') #originally "motion_score"
+    colormap = trackColormap(filtered=False)
     map.add_child(colormap)
 
-    for i in range(0, len(data)-1):
-        loc1 = data['latitude'].iloc[i], data['longitude'].iloc[i]
-        loc2 = data['latitude'].iloc[i+1], data['longitude'].iloc[i+1]
+    stays = []
+    if COLLAPSE_STOPS:
+        with span("buildmap.collapse"):
+            data, stays = collapseStays(data)
 
-        loc = [loc1, loc2]
-        
-        alt = data['motion_score'].iloc[i] #originally "motion_score"
+    if SIMPLIFY_TRACKS and TRACK_RENDER_MODE == "binned":
+        with span("buildmap.simplify"):
+            data = simplifiedTrack(user.username, data, colormap)
 
-        if not isNaN(alt):
-            color_ = colormap(alt)
-            folium.PolyLine(loc, weight=5, opacity=1, color=color_).add_to(map)
+    with span("buildmap.draw"):
+        addTrack(map, data.latitude, data.longitude, data.motion_score, colormap)
+        addStays(map, stays)
 
-    # add sigificant locations (home and work)
-    addSigificantLocations(user, map)
+        # add sigificant locations (home and work)
+        addSigificantLocations(user, map)
 
-    #save file
-    saveMap(map,filenumber)
+    return map
 
-#checks if a number is NaN by comparing it to itself
-#https://stackoverflow.com/questions/944700/how-can-i-check-for-nan-values
-def isNaN(num):
-    return num != num
+# same as buildmap, but the track is read and drawn in chunks (see STREAMING_MIN_SAMPLES)
+def buildStreamingMap(user):
+    track = track_store.open(user.username)
+    center = track_store.days(user.username).center()
 
+    map = folium.Map(
+        center,
+        zoom_start=ZOOM_START)
 
-# builds new map with filtered data range
-def build_date_map(user, req_start_date, req_end_date, req_start_time, req_end_time, filenumber):
+    colormap = trackColormap(filtered=False)
+    map.add_child(colormap)
 
-    # get Data for user
+    with span("buildmap.stream_lines"):
+        lines, stays = streamingTrackLines(track, colormap, center[0])
+
+    with span("buildmap.draw"):
+        for color, color_lines in lines.items():
+            folium.PolyLine(color_lines, weight=5, opacity=1, color=color).add_to(map)
+        addStays(map, stays)
+
+        # add sigificant locations (home and work)
+        addSigificantLocations(user, map)
+
+    return map
+
+
+# returns the chunks (slices of STREAM_CHUNK_SAMPLES samples) of a track
+# neighbouring chunks share one sample, so no segment of the track is lost between two chunks
+def trackChunks(track, overlap=1):
+    for start in range(0, max(len(track) - overlap, 1), STREAM_CHUNK_SAMPLES):
+        yield track[start:start + STREAM_CHUNK_SAMPLES + overlap]
+
+
+# like trackLines, but the track is simplified and binned chunk by chunk, so only the lines have to be in memory
+# "latitude" is the track's mean latitude, which is used for the simplification of all chunks
+# returns the lines and the stays (if COLLAPSE_STOPS is set, see collapseStays)
+def streamingTrackLines(track, colormap, latitude):
+    edges, _ = colorBins(colormap)
+    lines = {}
+    stays = []
+    if COLLAPSE_STOPS:
+        # the stays are found before drawing, so the trips on both sides of a stay split by chunks end at its marker
+        for chunk in trackChunks(track):
+            mergeStays(stays, findStays(chunk, *stayRuns(chunk.stop_id)), chunk)
+        stay_first = np.array([stay.first for stay in stays], dtype=np.int64)
+        stay_lat = np.array([stay.latitude for stay in stays], dtype=np.float64)
+        stay_lon = np.array([stay.longitude for stay in stays], dtype=np.float64)
+
+    for chunk in trackChunks(track):
+        if COLLAPSE_STOPS:
+            starts, ends = stayRuns(chunk.stop_id)
+            # the (merged) stay every run of the chunk belongs to
+            owner = np.searchsorted(stay_first, chunk.offset + starts, side="right") - 1
+            chunk = collapseRuns(chunk, starts, ends, stay_lat[owner], stay_lon[owner])
+        chunk_lat = np.asarray(chunk.latitude)
+        chunk_lon = np.asarray(chunk.longitude)
+        chunk_score = np.asarray(chunk.motion_score)
+        if SIMPLIFY_TRACKS:
+            keep = simplifyTrack(chunk_lat, chunk_lon, chunk_score, edges, SIMPLIFY_ZOOM, latitude)
+            chunk_lat, chunk_lon, chunk_score = chunk_lat[keep], chunk_lon[keep], chunk_score[keep]
+        for color, chunk_lines in trackLines(chunk_lat, chunk_lon, chunk_score, colormap).items():
+            lines.setdefault(color, []).extend(chunk_lines)
+    return lines, stays
+
+
+# returns the mean location of a track (computed in float64, the track's columns are float32), missing coordinates are
+# left out. if the track has no coordinates at all, the mean location of the user's whole track is returned
+def meanLocation(track, username):
+    if len(track) == 0 or np.isnan(track.latitude).all() or np.isnan(track.longitude).all():
+        return track_store.days(username).center()
+    return float(np.nanmean(track.latitude, dtype=np.float64)), float(np.nanmean(track.longitude, dtype=np.float64))
 
-    csv_path = "data/" + user.username + "/gps_samples_and_motion_score.csv"
 
-    data = pd.read_csv(csv_path)
-    print("Filter for: "+str(req_start_date)+" "+str(req_start_time)+" to "+str(req_end_date)+" "+str(req_end_time))
+#checks if a number is NaN by comparing it to itself
+#https://stackoverflow.com/questions/944700/how-can-i-check-for-nan-values
+def isNaN(num):
+    return num != num
 
-    # if no date is given, set to first and/or last possible day
-    if req_start_date == "" and req_end_date == "":
-        reqStartDateTime = datetime.strptime(data['ts'].iloc[0], '%Y-%m-%d %H:%M:%S+%f:00')
-        reqEndDateTime = datetime.strptime(data['ts'].iloc[len(data)-1], '%Y-%m-%d %H:%M:%S+%f:00')
-    elif req_start_date == "":
-        reqStartDateTime = datetime.strptime(data['ts'].iloc[0], '%Y-%m-%d %H:%M:%S+%f:00')
-        if req_end_time == "":
-            reqEndDateTime = datetime.strptime(req_end_date + "23:59", '%Y-%m-%d%H:%M')
-        else:
-            reqEndDateTime = datetime.strptime(req_end_date + req_end_time, '%Y-%m-%d%H:%M')    
-    elif req_end_date == "":
-        reqEndDateTime = datetime.strptime(data['ts'].iloc[len(data)-1], '%Y-%m-%d %H:%M:%S+%f:00')
-        if req_start_time == "":
-            reqStartDateTime = datetime.strptime(
-            req_start_date + "00:00", '%Y-%m-%d%H:%M')
-        else:
-            reqStartDateTime = datetime.strptime(
-            req_start_date + req_start_time, '%Y-%m-%d%H:%M')   
-
-    else: 
-        #if date but no time set to whole day
-        if req_start_time == "" and req_end_time == "":
-            reqStartDateTime = datetime.strptime(
-            req_start_date + "00:00", '%Y-%m-%d%H:%M')
-            reqEndDateTime = datetime.strptime(
-            req_end_date + "23:59", '%Y-%m-%d%H:%M')
-        elif req_start_time == "" and req_end_time != "":
-            reqStartDateTime = datetime.strptime(
-            req_start_date + "00:00", '%Y-%m-%d%H:%M')
-            reqEndDateTime = datetime.strptime(
-            req_end_date + req_end_time, '%Y-%m-%d%H:%M')
-        elif req_start_time != "" and req_end_time == "":
-            reqStartDateTime = datetime.strptime(
-            req_start_date + req_start_time, '%Y-%m-%d%H:%M')
-            reqEndDateTime = datetime.strptime(
-            req_end_date + "23:59", '%Y-%m-%d%H:%M')
+
+# colormap of the motion_score, filtered maps (see build_date_map) use different thresholds than the whole track
+def trackColormap(filtered):
+    if filtered:
+        index = [0, 100, 250, 500, 700, 1000]
+    else:
+        index = [0, 50, 100, 200, 600, 1000]
+    return cm.LinearColormap(colors=['darkblue', 'blue', 'green', 'yellow', 'orange', 'red'],
+                             index=index, vmin=0, vmax=1000,
+                             caption='motion score') #originally "motion_score"
+
+
+# returns the edges of the color bins and the color of every bin
+# every step of the colormap is split into COLOR_BINS_PER_STEP bins, each one colored like its center
+# values below/above the colormap's range get their own bins, colored like the colormap's first/last color
+def colorBins(colormap):
+    index = colormap.index
+    edges = np.unique(np.concatenate([np.linspace(index[i], index[i+1], COLOR_BINS_PER_STEP+1) for i in range(len(index)-1)]))
+    centers = (edges[:-1] + edges[1:]) / 2
+
+    colors = [colormap(edges[0])] + [colormap(c) for c in centers] + [colormap(edges[-1])]
+    return edges, colors
+
+
+# quantizes the motion_score of every segment (sample i to sample i+1) into the given bins
+# segments without motion_score get the bin -1
+def segmentBins(motion_score, edges):
+    # the last sample doesn't start a segment
+    score = np.asarray(motion_score[:-1], dtype=np.float64)
+    bins = np.digitize(score, edges)
+    bins[np.isnan(score)] = -1
+    return bins
+
+
+# quantizes the motion_score of every segment (sample i to sample i+1) into the colormap's bins
+# and merges consecutive segments of the same bin into one line
+# returns a dictionary {color: [line, line, ...]}, where a line is a list of [lat, lon] pairs ([lon, lat] if lonlat is set)
+def trackLines(latitude, longitude, motion_score, colormap, lonlat=False):
+    if len(latitude) < 2:
+        return {}
+
+    edges, colors = colorBins(colormap)
+
+    # segments without motion_score are not drawn (same as before)
+    bins = segmentBins(motion_score, edges)
+
+    # a new line starts wherever the bin changes
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(bins)) + 1))
+    ends = np.append(starts[1:], len(bins))
+
+    # 6 decimals (~0.1m) are more than enough, more digits (float32 noise) only bloat the html file
+    columns = (longitude, latitude) if lonlat else (latitude, longitude)
+    coordinates = np.round(np.column_stack(columns).astype(np.float64), 6).tolist()
+
+    lines = {}
+    for start, end, b in zip(starts, ends, bins[starts]):
+        if b < 0:
+            continue
+        # segments start...end-1 cover the samples start...end
+        lines.setdefault(colors[b], []).append(coordinates[start:end+1])
+    return lines
+
+
+# returns the maximum distance between the simplified and the original track for the given zoom level
+# in degrees of latitude (see douglasPeucker())
+def simplificationTolerance(zoom, latitude):
+    # size of a pixel at this zoom level and latitude in meters (web mercator, 256 pixel tiles)
+    meters_per_pixel = 156543.03392 * np.cos(np.radians(latitude)) / 2**zoom
+    return SIMPLIFY_PIXELS * meters_per_pixel / 111320.0
+
+
+# Douglas-Peucker: marks the points between start and end (both are kept) in "keep", that are needed so the
+# line doesn't differ more than "tolerance" from the original one
+# x and y need to be projected coordinates in the unit of tolerance
+def douglasPeucker(x, y, start, end, tolerance, keep):
+    stack = [(start, end)]
+    while stack:
+        a, b = stack.pop()
+        if b - a < 2:
+            continue
+
+        # distances of all points between a and b to the line a-b
+        dx, dy = x[b] - x[a], y[b] - y[a]
+        px, py = x[a+1:b] - x[a], y[a+1:b] - y[a]
+        length = np.hypot(dx, dy)
+        if length == 0:
+            distance = np.hypot(px, py)
         else:
-            reqStartDateTime = datetime.strptime(
-            req_start_date + req_start_time, '%Y-%m-%d%H:%M')
-            reqEndDateTime = datetime.strptime(
-            req_end_date + req_end_time, '%Y-%m-%d%H:%M')
+            distance = np.abs(px * dy - py * dx) / length
+
+        i = np.argmax(distance)
+        if distance[i] > tolerance:
+            m = a + 1 + i
+            keep[m] = True
+            stack.append((a, m))
+            stack.append((m, b))
+
+
+# returns a boolean mask of the samples of the track, which are needed to draw it at the given zoom level
+# the first sample of every color bin is always kept, so colors are exactly the same as without simplification
+# mean_latitude is used for the projection and tolerance, by default the mean latitude of the given samples
+def simplifyTrack(latitude, longitude, motion_score, edges, zoom, mean_latitude=None):
+    n = len(latitude)
+    keep = np.zeros(n, dtype=bool)
+    if n < 3:
+        keep[:] = True
+        return keep
+
+    # equirectangular projection, good enough for the extent of a track
+    lat = latitude.astype(np.float64)
+    lon = longitude.astype(np.float64)
+    mean_lat = np.nanmean(lat) if mean_latitude is None else mean_latitude
+    x = lon * np.cos(np.radians(mean_lat))
+    y = lat
+
+    tolerance = simplificationTolerance(zoom, mean_lat)
+
+    # runs of segments in the same bin, their first and last sample are kept
+    bins = segmentBins(motion_score, edges)
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(bins)) + 1))
+    ends = np.append(starts[1:], n - 1)
+    keep[starts] = True
+    keep[-1] = True
+
+    for start, end in zip(starts, ends):
+        douglasPeucker(x, y, start, end, tolerance, keep)
+    return keep
+
+
+# returns the track with all samples left out, which wouldn't be visible at the given zoom level (default: SIMPLIFY_ZOOM)
+# the result for the user's whole track is cached per user, version of the track and tolerance
+# a slice of the track (see Track.between) or a collapsed track (see collapseStays) is always simplified on its own
+# without cache, so the same slice gives the same result, no matter which maps have been drawn before
+def simplifiedTrack(username, track, colormap, zoom=None):
+    if zoom is None:
+        zoom = SIMPLIFY_ZOOM
+    edges, _ = colorBins(colormap)
+
+    if track.offset != 0 or len(track) < len(track_store.open(username)):
+        return track.take(simplifyTrack(track.latitude, track.longitude, track.motion_score, edges, zoom))
+
+    key = (username, track.version, zoom, SIMPLIFY_PIXELS, tuple(edges))
+    keep = simplification_cache.get(key)
+    if keep is None:
+        keep = simplifyTrack(track.latitude, track.longitude, track.motion_score, edges, zoom)
+        simplification_cache.put(key, keep, keep.nbytes)
+    return track.take(keep)
+
+
+# returns the index of the first and last sample of every stay in a track
+# a stay is a run of consecutive samples with the same stop_id, samples with stop_id -1 are on trips
+def stayRuns(stop_id):
+    stop_id = np.asarray(stop_id)
+    if len(stop_id) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    change = np.flatnonzero(np.diff(stop_id)) + 1
+    starts = np.concatenate(([0], change))
+    ends = np.append(change - 1, len(stop_id) - 1)
+    stay = stop_id[starts] != -1
+    return starts[stay], ends[stay]
+
+
+# sums of the values between start and end (both inclusive) of every run, missing values are left out
+# returns the sums and the number of values, which aren't missing
+def runSums(values, starts, ends):
+    values = np.asarray(values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    # reduceat sums from one index to the next, every run gets the pair (start, end + 1)
+    indices = np.column_stack((starts, ends + 1)).ravel()
+    sums = np.add.reduceat(np.append(np.where(valid, values, 0), 0), indices)[::2]
+    counts = np.add.reduceat(np.append(valid, False).astype(np.int64), indices)[::2]
+    return sums, counts
+
+
+# returns the stays (see stayRuns) of a track as a list of objects with the attributes
+# stop_id, latitude, longitude (mean location), start, end (seconds since epoch), utc_offset, samples,
+# latitude_sum, latitude_count, longitude_sum, longitude_count (sums of the coordinates, which aren't missing) and
+# first, last (index of the first/last sample in the user's whole track, used to merge stays split by chunks, see mergeStays)
+def findStays(track, starts, ends):
+    lat_sums, lat_counts = runSums(track.latitude, starts, ends)
+    lon_sums, lon_counts = runSums(track.longitude, starts, ends)
+
+    offset = track.offset or 0
+    stays = [SimpleNamespace(stop_id=int(track.stop_id[s]), start=int(track.ts[s]), end=int(track.ts[e]),
+                             utc_offset=int(track.utc_offset[s]), samples=int(e - s + 1),
+                             latitude_sum=float(lat_sum), latitude_count=int(lat_count),
+                             longitude_sum=float(lon_sum), longitude_count=int(lon_count),
+                             first=offset + int(s), last=offset + int(e))
+             for s, e, lat_sum, lat_count, lon_sum, lon_count in zip(starts, ends, lat_sums, lat_counts, lon_sums, lon_counts)]
+    for stay in stays:
+        locateStay(stay)
+    return stays
+
+
+# sets the stay's latitude and longitude to the mean of its samples (NaN if none of them has coordinates)
+def locateStay(stay):
+    stay.latitude = stay.latitude_sum / stay.latitude_count if stay.latitude_count > 0 else float("nan")
+    stay.longitude = stay.longitude_sum / stay.longitude_count if stay.longitude_count > 0 else float("nan")
+
+
+# collapses the runs (see stayRuns) into their first and last sample, which are both moved to the given location
+# the segment between them isn't drawn (its motion_score is NaN), so the trips to and from the stop end at its marker
+def collapseRuns(track, starts, ends, latitude, longitude):
+    if len(starts) == 0:
+        return track
+
+    # samples inside a stay are left out, its first and last one are kept
+    inside = np.zeros(len(track) + 1, dtype=np.int64)
+    inside[starts] += 1
+    inside[ends + 1] -= 1
+    keep = np.cumsum(inside)[:-1] == 0
+    keep[starts] = True
+    keep[ends] = True
+
+    collapsed = track.take(keep)
+    # the columns of memory-mapped tracks (see TrackStore.open) stay read-only when taken
+    collapsed.latitude, collapsed.longitude, collapsed.motion_score = \
+        np.array(collapsed.latitude), np.array(collapsed.longitude), np.array(collapsed.motion_score)
+    position = np.cumsum(keep) - 1
+    first, last = position[starts], position[ends]
+    collapsed.latitude[first] = collapsed.latitude[last] = latitude
+    collapsed.longitude[first] = collapsed.longitude[last] = longitude
+    collapsed.motion_score[first[last > first]] = np.nan
+    return collapsed
+
+
+# collapses every stay into its first and last sample at the stay's mean location (see collapseRuns)
+# returns the remaining samples as a new track and the stays (see findStays)
+def collapseStays(track):
+    starts, ends = stayRuns(track.stop_id)
+    if len(starts) == 0:
+        return track, []
+
+    stays = findStays(track, starts, ends)
+    latitude = np.array([stay.latitude for stay in stays], dtype=np.float64)
+    longitude = np.array([stay.longitude for stay in stays], dtype=np.float64)
+    return collapseRuns(track, starts, ends, latitude, longitude), stays
+
+
+# appends the stays of the next chunk to "stays"
+# neighbouring chunks share a sample (see trackChunks), so a stay split by them is merged again
+# the shared sample (the chunk's first one) is part of both, so its coordinates are only counted once
+def mergeStays(stays, more, chunk):
+    if stays and more and stays[-1].last == more[0].first and stays[-1].stop_id == more[0].stop_id:
+        stay, next = stays[-1], more[0]
+        shared_lat, shared_lon = float(chunk.latitude[0]), float(chunk.longitude[0])
+        if not isNaN(shared_lat):
+            stay.latitude_sum -= shared_lat
+            stay.latitude_count -= 1
+        if not isNaN(shared_lon):
+            stay.longitude_sum -= shared_lon
+            stay.longitude_count -= 1
+        stay.latitude_sum += next.latitude_sum
+        stay.latitude_count += next.latitude_count
+        stay.longitude_sum += next.longitude_sum
+        stay.longitude_count += next.longitude_count
+        locateStay(stay)
+        stay.end = next.end
+        stay.last = next.last
+        stay.samples += next.samples - 1
+        more = more[1:]
+    stays.extend(more)
+
+
+# text shown for a stay, e.g. "Aufenthalt: 2022-03-30 20:42 bis 2022-03-31 14:39 (17 h 56 min)"
+def stayText(stay):
+    def local(ts):
+        return datetime.utcfromtimestamp(ts + stay.utc_offset).strftime("%Y-%m-%d %H:%M")
+
+    minutes = (stay.end - stay.start) // 60
+    return "Aufenthalt: " + local(stay.start) + " bis " + local(stay.end) + \
+           " (" + str(minutes // 60) + " h " + str(minutes % 60) + " min)"
+
+
+# radius of a stay's marker, which grows with the logarithm of the duration
+def stayRadius(stay):
+    hours = (stay.end - stay.start) / 3600
+    return float(min(STAY_MIN_RADIUS + 2 * np.log2(max(hours, 1)), STAY_MAX_RADIUS))
+
+
+# adds a marker for every stay (see collapseStays) to the map
+def addStays(map, stays):
+    for stay in stays:
+        if isNaN(stay.latitude) or isNaN(stay.longitude):
+            continue
+        folium.CircleMarker((round(stay.latitude, 6), round(stay.longitude, 6)), radius=stayRadius(stay),
+                            color="black", weight=1, fill=True, fill_color="white", fill_opacity=0.8,
+                            tooltip=stayText(stay)).add_to(map)
+
+
+# adds the track to the map, either binned (one multi-polyline per color) or one polyline per segment
+# binned tracks are simplified first (if SIMPLIFY_TRACKS is set)
+def addTrack(map, latitude, longitude, motion_score, colormap):
+    if TRACK_RENDER_MODE == "segments":
+        for i in range(0, len(latitude)-1):
+            alt = motion_score[i]
+            if not isNaN(alt):
+                loc = [(latitude[i], longitude[i]), (latitude[i+1], longitude[i+1])]
+                folium.PolyLine(loc, weight=5, opacity=1, color=colormap(alt)).add_to(map)
+        return
+
+    for color, lines in trackLines(latitude, longitude, motion_score, colormap).items():
+        folium.PolyLine(lines, weight=5, opacity=1, color=color).add_to(map)
 
-    newData = pd.DataFrame()
 
-    #print(data['ts'].iloc[0])
-    #print(data['ts'].iloc[len(data)-1])
+# builds new map with filtered data range
+def build_date_map(user, req_start_date, req_end_date, req_start_time, req_end_time):
 
-    for i in range(0, len(data)-1):
-        dataDate = data['ts'].iloc[i]
+    print("Filter for: "+str(req_start_date)+" "+str(req_start_time)+" to "+str(req_end_date)+" "+str(req_end_time))
 
-        # date from timestamp in data
-        data_date = datetime.strptime(dataDate, '%Y-%m-%d %H:%M:%S+%f:00')
-        if data_date >= reqStartDateTime and data_date <= reqEndDateTime:
-            newData = pd.concat([newData, data.iloc[[i]]])
+    # get Data for user
+    with span("build_date_map.filter"):
+        newData = filter_by_date_range(user.username, req_start_date, req_start_time, req_end_date, req_end_time)
 
     # if dataframe is empty (no locations at selected date intervall) then build empty map doesn't work, idk why
 
-    if (newData.empty):
-        location = data['latitude'].mean(), data['longitude'].mean()
+    if len(newData) == 0:
+        location = track_store.days(user.username).center()
         map = folium.Map(
             location,
-            zoom_start=10)
+            zoom_start=ZOOM_START)
 
-        colormap = cm.LinearColormap(colors=['darkblue', 'blue', 'green', 'yellow', 'orange', 'red'],
-                                     index=[0, 100, 250, 500, 700, 1000], vmin=0, vmax=1000,
-                                     caption='motion score')
+        colormap = trackColormap(filtered=True)
         map.add_child(colormap)
 
-        #save file
-        saveMap(map,filenumber)
-
     else:
 
         # create new folium map with filterd Data
-        location = newData['latitude'].mean(), newData['longitude'].mean()
+        location = meanLocation(newData, user.username)
 
         map = folium.Map(
             location,
-            zoom_start=10)
+            zoom_start=ZOOM_START)
 
-        colormap = cm.LinearColormap(colors=['darkblue', 'blue', 'green', 'yellow', 'orange', 'red'],
-                                     index=[0, 100, 250, 500, 700, 1000], vmin=0, vmax=1000,
-                                     caption='motion score') #originally "motion_score"
+        colormap = trackColormap(filtered=True)
         map.add_child(colormap)
 
-        for i in range(0, len(newData)-1):
-            loc1 = newData['latitude'].iloc[i], newData['longitude'].iloc[i]
-            loc2 = newData['latitude'].iloc[i +
-                                            1], newData['longitude'].iloc[i+1]
+        stays = []
+        if COLLAPSE_STOPS:
+            with span("build_date_map.collapse"):
+                newData, stays = collapseStays(newData)
 
-            loc = [loc1, loc2]
-            
-            alt = newData['motion_score'].iloc[i] #originally "motion_score"
+        if SIMPLIFY_TRACKS and TRACK_RENDER_MODE == "binned":
+            with span("build_date_map.simplify"):
+                newData = simplifiedTrack(user.username, newData, colormap)
 
-            if not isNaN(alt):
-                color_ = colormap(alt)
-                folium.PolyLine(loc, weight=5, opacity=1, color=color_).add_to(map)
+        with span("build_date_map.draw"):
+            addTrack(map, newData.latitude, newData.longitude, newData.motion_score, colormap)
+            addStays(map, stays)
 
     # add sigificant locations (home and work)
     addSigificantLocations(user, map)
 
-    #save file
-    saveMap(map,filenumber)
+    return map
 
 
+# returns the (filtered) track and significant locations of the user as GeoJSON FeatureCollection, used by the
+# client-side map (see trackmap.html), which only needs to fetch this data instead of a whole folium map
+# the track consists of one MultiLineString per color bin (see trackLines)
+# filtered: whether the filter form has been submitted, the track and colormap are then the same as in build_date_map,
+# even if all fields are empty
+def trackGeoJSON(user, start_date, end_date, start_time, end_time, filtered, zoom=None):
+    if filtered:
+        track = filter_by_date_range(user.username, start_date, start_time, end_date, end_time)
+    else:
+        track = track_store.get(user.username)
+
+    colormap = trackColormap(filtered)
+    stays = []
+    if COLLAPSE_STOPS:
+        track, stays = collapseStays(track)
+    if SIMPLIFY_TRACKS:
+        track = simplifiedTrack(user.username, track, colormap, zoom)
+
+    features = []
+    for color, lines in trackLines(track.latitude, track.longitude, track.motion_score, colormap, lonlat=True).items():
+        features.append({"type": "Feature",
+                         "geometry": {"type": "MultiLineString", "coordinates": lines},
+                         "properties": {"kind": "track", "color": color}})
+
+    for stay in stays:
+        if isNaN(stay.latitude) or isNaN(stay.longitude):
+            continue
+        features.append({"type": "Feature",
+                         "geometry": {"type": "Point", "coordinates": [round(stay.longitude, 6), round(stay.latitude, 6)]},
+                         "properties": {"kind": "stay", "text": stayText(stay), "radius": stayRadius(stay)}})
+
+    # the same significant locations as in addSigificantLocations()
+    sigLocs = [("home", home) for home in user.home[:1]] + [("work", work) for work in user.work]
+    for kind, loc in sigLocs:
+        visited = str(toDate(loc.timestamp)) if kind == "work" and len(user.work) > 1 and loc.timestamp else None
+        features.append({"type": "Feature",
+                         "geometry": {"type": "Point", "coordinates": [loc.longitude, loc.latitude]},
+                         "properties": {"kind": kind, "adress": loc.adress, "visited": visited}})
+
+    center = meanLocation(track, user.username)
+
+    return {"type": "FeatureCollection",
+            "features": features,
+            "center": center,
+            "zoom": ZOOM_START,
+            "colormap": {"index": colormap.index, "colors": [colormap(i) for i in colormap.index]}}
+
+
+# returns the user's mobility report (parsed once, see mobilityreport.py)
 def metadata(current_user):
-    csv_path = "data/" + current_user.username + "/mobility_report" + ".csv"
-    df = pd.read_csv(csv_path)
-    return df
+    return mobility_reports.get(current_user.username)
@@ -0,0 +1,178 @@
+import cProfile
+import threading
+import time
+from contextlib import contextmanager
+from os import path, makedirs
+
+from flask import g, request, Response, current_app
+from jinja2 import Template
+
+
+# Counters and latency histograms of the app, served in the Prometheus text format on "/metrics".
+# Every request is timed (loctrace_request_duration_seconds) and counted (loctrace_requests_total).
+# The stages of building maps, calculating significant locations and geocoding are timed as named spans
+# (loctrace_span_seconds), e.g. "with span('buildmap.track'): ...", which works in any thread.
+# If the app's config "PROFILE_REQUESTS" is set, every request is profiled with cProfile and the profile is saved
+# in PROFILE_DIR (open it with e.g. "python -m pstats <file>" or snakeviz). This makes requests a lot slower.
+
+PROFILE_DIR = "profiles/"
+
+# upper bounds of the histograms' buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def escapeLabel(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+# labels are a tuple of (name, value) pairs
+def formatLabels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(name + "=\"" + escapeLabel(value) + "\"" for name, value in labels) + "}"
+
+
+def formatValue(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = ["# HELP " + self.name + " " + self.help, "# TYPE " + self.name + " counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(self.name + formatLabels(labels) + " " + formatValue(value))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket..., sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[i] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    def render(self):
+        lines = ["# HELP " + self.name + " " + self.help, "# TYPE " + self.name + " histogram"]
+        with self._lock:
+            for labels, values in sorted(self._values.items()):
+                for bound, count in zip(self.buckets + (float("inf"),), values[:len(self.buckets)] + [values[-1]]):
+                    lines.append(self.name + "_bucket" + formatLabels(labels + (("le", formatValue(bound)),)) + " " + str(count))
+                lines.append(self.name + "_sum" + formatLabels(labels) + " " + formatValue(values[-2]))
+                lines.append(self.name + "_count" + formatLabels(labels) + " " + str(values[-1]))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name, help):
+        with self._lock:
+            return self._metrics.setdefault(name, Counter(name, help))
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        with self._lock:
+            return self._metrics.setdefault(name, Histogram(name, help, buckets))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+requests_total = registry.counter("loctrace_requests_total", "Number of requests by endpoint, method and status.")
+request_duration = registry.histogram("loctrace_request_duration_seconds", "Duration of requests by endpoint and method.")
+span_duration = registry.histogram("loctrace_span_seconds", "Duration of named stages (building maps, geocoding, ...).")
+
+
+# times the code inside the with-block as span "name"
+@contextmanager
+def span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        span_duration.observe(time.perf_counter() - start, span=name)
+
+
+# templates of the app are rendered inside a span, so the time spent rendering them shows up as well
+class TimedTemplate(Template):
+    def render(self, *args, **kwargs):
+        with span("template." + str(self.name)):
+            return super().render(*args, **kwargs)
+
+
+def beforeRequest():
+    g.metrics_start = time.perf_counter()
+
+    if g.get("metrics_profile") is None and request.endpoint != "metrics" and profilingEnabled():
+        g.metrics_profile = cProfile.Profile()
+        g.metrics_profile.enable()
+
+
+def afterRequest(response):
+    profile = g.pop("metrics_profile", None)
+    if profile is not None:
+        profile.disable()
+        saveProfile(profile)
+
+    start = g.pop("metrics_start", None)
+    if start is not None:
+        endpoint = request.endpoint or "unknown"
+        request_duration.observe(time.perf_counter() - start, endpoint=endpoint, method=request.method)
+        requests_total.inc(endpoint=endpoint, method=request.method, status=str(response.status_code))
+    return response
+
+
+def profilingEnabled():
+    return bool(current_app.config.get("PROFILE_REQUESTS"))
+
+
+def saveProfile(profile):
+    makedirs(PROFILE_DIR, exist_ok=True)
+    filename = time.strftime("%Y%m%d-%H%M%S") + "-" + str(request.endpoint) + "-" + str(threading.get_ident()) + ".prof"
+    profile.dump_stats(path.join(PROFILE_DIR, filename))
+
+
+def metrics():
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+# registers the request hooks and the "/metrics" route
+def init_app(app):
+    app.before_request(beforeRequest)
+    app.after_request(afterRequest)
+    app.add_url_rule("/metrics", "metrics", metrics)
+    app.jinja_env.template_class = TimedTemplate
@@ -0,0 +1,82 @@
+from os import path, stat
+
+import numpy as np
+import pandas as pd
+
+from .cache import LRUCache
+
+
+# Every user's "mobility_report.csv" is parsed once and kept in memory, so "/map/" doesn't have to read it on
+# every request. Like the tracks (see trackstore.py), a report is parsed again whenever its csv changes.
+# The reports of all users are parsed while the database is loaded (see load_database() in auth.py).
+
+DATA_DIR = "data/"
+REPORT_FILE = "mobility_report.csv"
+
+# maximum number of reports kept in memory (a report is only a few kilobytes)
+REPORT_CACHE_MAX_ENTRIES = 10000
+
+
+# the parts of a user's mobility report shown in map.html
+# summary:   the first row of the report ("whole period") as {column: value}, numbers are ints or floats
+class MobilityReport:
+    def __init__(self, summary, version=None):
+        self.summary = summary
+        self.version = version
+
+
+# converts numpy values (np.int64, np.float64, ...) into python values
+def toPython(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def readReportCsv(csv_path, version=None):
+    df = pd.read_csv(csv_path)
+
+    summary = {}
+    if len(df) > 0:
+        summary = {column: toPython(value) for column, value in df.loc[0].items()}
+
+    return MobilityReport(summary, version=version)
+
+
+class MobilityReportStore:
+    def __init__(self, data_dir=DATA_DIR, max_entries=REPORT_CACHE_MAX_ENTRIES):
+        self.data_dir = data_dir
+        self._reports = LRUCache(max_entries)
+
+    def csvPath(self, username):
+        return path.join(self.data_dir, username, REPORT_FILE)
+
+    # the version of a report changes whenever the csv is modified
+    def version(self, username):
+        st = stat(self.csvPath(username))
+        return str(st.st_mtime_ns) + "-" + str(st.st_size)
+
+    # returns the MobilityReport of a user, raises FileNotFoundError if the user has no report
+    def get(self, username):
+        version = self.version(username)
+
+        report = self._reports.get(username)
+        if report is not None and report.version == version:
+            return report
+
+        report = readReportCsv(self.csvPath(username), version)
+        self._reports.put(username, report)
+        return report
+
+    # parses the reports of all given users, which aren't in memory yet
+    def load(self, usernames):
+        loaded = 0
+        for username in usernames:
+            try:
+                self.get(username)
+                loaded += 1
+            except FileNotFoundError:
+                print("User '" + username + "' has no mobility report.")
+        return loaded
+
+
+mobility_reports = MobilityReportStore()
@@ -35,8 +35,20 @@ class Stop_w(db.Model):
     timestamp = db.Column(db.String(150))
     adress = db.Column(db.String(250))
 
+#answers of the survey, one row per submission (see surveystore.py)
+#the newest answer of a user and part counts, export_survey.py writes them into "surveyData/"
+class SurveyAnswer(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+
+    part = db.Column(db.Integer)
+    data = db.Column(db.LargeBinary)
+    received = db.Column(db.DateTime)
+
 class State(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     db_loaded = db.Column(db.Boolean)
     sigLoc_loaded = db.Column(db.Boolean)
+    #version (modification time and size) of the login data the passwords have last been checked against, see load_users() in auth.py
+    logindata_version = db.Column(db.String(64))
    
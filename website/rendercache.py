@@ -0,0 +1,199 @@
+import gzip
+import hashlib
+import json
+import shutil
+import threading
+import time
+from os import path, makedirs, listdir, remove, replace, stat, utime, getpid
+
+from flask import request, send_file
+
+from .metrics import span
+
+# brotli is optional, without it maps are only compressed with gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Rendered maps are saved as "website/templates/iframes/<user_id>-<hash>.html".
+# The hash is computed from everything the map depends on (user, filter, version of the data), so a map only
+# has to be rendered once and every following request for the same map is served from disk.
+# If the directory grows bigger than MAP_CACHE_MAX_BYTES, the least recently used maps are deleted. Maps that
+# were used less than MAP_LEASE_SECONDS ago are never deleted, so a map can't disappear between the request
+# to "/map/" and the request of its iframe, even if other users request maps at the same time.
+# Every map is compressed once right after it has been rendered ("<user_id>-<hash>.html.gz" and, if the package
+# brotli is installed, ".html.br"), send() then streams the smallest version the browser accepts directly from disk.
+
+MAP_DIR = "website/templates/iframes/"
+
+MAP_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+MAP_LEASE_SECONDS = 10 * 60
+
+MAP_GZIP_LEVEL = 9
+
+MAP_BROTLI_QUALITY = 9
+
+# Content-Encoding -> suffix of the compressed file, in the order they are preferred
+MAP_ENCODINGS = [("br", ".br"), ("gzip", ".gz")] if brotli is not None else [("gzip", ".gz")]
+
+
+class RenderCache:
+    def __init__(self, directory=MAP_DIR, max_bytes=MAP_CACHE_MAX_BYTES, lease_seconds=MAP_LEASE_SECONDS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lease_seconds = lease_seconds
+        # one lock per key, so the same map is never rendered twice at the same time
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    # builds the key of a map, "parts" can be anything json can handle
+    # the user's id is kept readable, so "/displaymap/" can check that a map belongs to the user requesting it
+    def key(self, user_id, *parts):
+        digest = hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        return str(user_id) + "-" + digest
+
+    # a valid key has the form "<user_id>-<sha256>", anything else (e.g. paths) is rejected
+    @staticmethod
+    def isValidKey(key):
+        if not key or key.count("-") != 1:
+            return False
+        user_id, digest = key.split("-")
+        return user_id.isdigit() and len(digest) == 64 and all(c in "0123456789abcdef" for c in digest)
+
+    @staticmethod
+    def belongsTo(key, user_id):
+        return RenderCache.isValidKey(key) and key.split("-")[0] == str(user_id)
+
+    def filename(self, key):
+        return key + ".html"
+
+    def path(self, key):
+        return path.join(self.directory, self.filename(key))
+
+    def exists(self, key):
+        return self.isValidKey(key) and path.exists(self.path(key))
+
+    # renews the lease of an existing map and marks it as recently used (see evict()), returns whether it exists
+    # has to be called whenever a cached map is used instead of rendered, otherwise it could be deleted before
+    # its iframe requests it
+    def touch(self, key):
+        if not self.exists(key):
+            return False
+        self._touch(self.path(key))
+        return True
+
+    def _lock(self, key):
+        with self._locks_lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    # makes sure the map with the given key exists, "build" is only called if it doesn't
+    # "build" has to return a folium map
+    def render(self, key, build):
+        file = self.path(key)
+
+        rendered = False
+        try:
+            with self._lock(key):
+                if path.exists(file):
+                    # renew the lease and mark as recently used
+                    self._touch(file)
+                else:
+                    makedirs(self.directory, exist_ok=True)
+
+                    # write into a temporary file first, so a half-written map is never served
+                    tmp = file + ".tmp-" + str(getpid()) + "-" + str(threading.get_ident())
+                    with span("map.build"):
+                        map = build()
+                    with span("map.save"):
+                        map.save(tmp)
+                    # the compressed versions have to be ready before the map itself, see send()
+                    with span("map.compress"):
+                        for encoding, suffix in MAP_ENCODINGS:
+                            compressFile(tmp, tmp + suffix, encoding)
+                            replace(tmp + suffix, file + suffix)
+                    replace(tmp, file)
+                    rendered = True
+        finally:
+            # also if build() raised, otherwise the lock of the key would be kept forever
+            with self._locks_lock:
+                self._locks.pop(key, None)
+
+        if rendered:
+            self.evict()
+        return file
+
+    # streams the map with the given key, compressed if the browser accepts one of MAP_ENCODINGS
+    # the key changes whenever the map does, so it is used as ETag and browsers only download a map once
+    def send(self, key):
+        file = self.path(key)
+        suffixes = {encoding: suffix for encoding, suffix in MAP_ENCODINGS if path.exists(file + suffix)}
+        encoding = request.accept_encodings.best_match(list(suffixes) + ["identity"], default="identity")
+        suffix = suffixes.get(encoding, "")
+
+        # relative paths would be relative to the app's folder ("website/")
+        response = send_file(path.abspath(file + suffix), mimetype="text/html", etag=key + suffix, conditional=True)
+        if suffix:
+            response.content_encoding = encoding
+        response.vary.add("Accept-Encoding")
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+
+    def _touch(self, file):
+        try:
+            utime(file, None)
+        except OSError:
+            pass
+
+    # deletes least recently used maps until the directory fits into max_bytes again
+    # the modification time of a map is its last use (see render() and touch()), so this works across processes as well
+    # a map and its compressed versions are deleted together
+    def evict(self):
+        maps = {}
+        total = 0
+        for f in listdir(self.directory):
+            try:
+                st = stat(path.join(self.directory, f))
+            except OSError:
+                continue
+            mtime, size, files = maps.get(f.split(".")[0], (0, 0, []))
+            maps[f.split(".")[0]] = (max(mtime, st.st_mtime), size + st.st_size, files + [f])
+            total += st.st_size
+
+        if total <= self.max_bytes:
+            return
+
+        now = time.time()
+        for mtime, size, files in sorted(maps.values()):
+            if total <= self.max_bytes:
+                break
+            # leased maps might still be requested by an iframe
+            if now - mtime < self.lease_seconds:
+                break
+            # the map itself first, so it isn't found anymore while its compressed versions are deleted
+            for f in sorted(files, key=len):
+                try:
+                    remove(path.join(self.directory, f))
+                except OSError:
+                    pass
+            total -= size
+
+
+# writes the compressed version of a file
+def compressFile(source, destination, encoding):
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        if encoding == "br":
+            compressor = brotli.Compressor(quality=MAP_BROTLI_QUALITY)
+            for chunk in iter(lambda: src.read(1024 * 1024), b""):
+                dst.write(compressor.process(chunk))
+            dst.write(compressor.finish())
+        else:
+            # mtime=0, so the same map is always compressed into the same bytes
+            with gzip.GzipFile(filename="", mode="wb", fileobj=dst, compresslevel=MAP_GZIP_LEVEL, mtime=0) as gz:
+                shutil.copyfileobj(src, gz, 1024 * 1024)
+
+
+map_cache = RenderCache()
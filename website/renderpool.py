@@ -0,0 +1,73 @@
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from .cache import LRUCache
+from .rendercache import map_cache
+
+
+# Maps are built by a fixed number of background threads instead of the request threads, so a burst of users
+# requesting their maps at the same time can't block all of the server's workers (or its memory).
+# At most RENDER_MAX_JOBS maps are waiting or being built at the same time, further requests are rejected until
+# a job has finished. Requests for a map that is already being built wait for that job instead of starting a new one.
+
+RENDER_WORKERS = 2
+
+RENDER_MAX_JOBS = 32
+
+# number of failed maps remembered, so "/displaymap/" can tell them apart from maps built by another process
+RENDER_FAILED_MAX_ENTRIES = 1000
+
+
+class RenderPool:
+    def __init__(self, workers=RENDER_WORKERS, max_jobs=RENDER_MAX_JOBS):
+        self.max_jobs = max_jobs
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="render")
+        # maps which are waiting or being built, key -> Future
+        self._jobs = {}
+        # keys of maps whose build raised in this process, until they are submitted again
+        self._failed = LRUCache(RENDER_FAILED_MAX_ENTRIES)
+        self._lock = threading.Lock()
+
+    # starts building the map with the given key (see RenderCache.render), "build" has to return a folium map
+    # "build" is called in another thread, so it must not use anything bound to the request (e.g. current_user)
+    # returns the job's Future or None, if there are too many jobs already
+    def submit(self, key, build):
+        with self._lock:
+            if key in self._jobs:
+                return self._jobs[key]
+
+            if len(self._jobs) >= self.max_jobs:
+                return None
+
+            self._failed.pop(key)
+            future = self._executor.submit(self._run, key, build)
+            self._jobs[key] = future
+
+        future.add_done_callback(lambda f: self._done(key))
+        return future
+
+    # returns the Future of the map with the given key, if it is waiting or being built
+    def job(self, key):
+        with self._lock:
+            return self._jobs.get(key)
+
+    # whether the last build of the map with the given key in this process raised
+    def failed(self, key):
+        return self._failed.get(key) is not None
+
+    def _run(self, key, build):
+        try:
+            return map_cache.render(key, build)
+        except Exception:
+            print("Error while building map " + key + ":")
+            traceback.print_exc()
+            self._failed.put(key, True)
+            raise
+
+    def _done(self, key):
+        with self._lock:
+            self._jobs.pop(key, None)
+
+
+render_pool = RenderPool()
@@ -0,0 +1,194 @@
+import threading
+import zipfile
+from os import path, stat, replace, getpid
+
+import numpy as np
+import pandas as pd
+
+from .cache import LRUCache
+
+
+# Every user's stops are indexed in a grid of GRID_CELL_METERS x GRID_CELL_METERS cells, so the visits near a point
+# ("when did the participant visit within 200m of X?") are found by looking only at the few cells around it.
+# The index is saved next to the user's data ("data/<user>/stop_index.npz") and built again whenever "stops.csv"
+# changes. The indexes of all users are built while the database is loaded (see load_database() in auth.py).
+
+DATA_DIR = "data/"
+STOPS_FILE = "stops.csv"
+INDEX_FILE = "stop_index.npz"
+
+# increase this, if the format of the index changes, so old indexes are built again
+INDEX_FORMAT_VERSION = 1
+
+GRID_CELL_METERS = 250.0
+
+# maximum number of indexes kept in memory
+STOP_INDEX_MAX_ENTRIES = 1000
+
+# cells are counted from this offset, so the keys of cells west/south of (0, 0) are positive as well
+CELL_OFFSET = 2**20
+
+METERS_PER_DEGREE = 111320.0
+EARTH_RADIUS = 6371000.0
+
+
+# distance in meters between a point and arrays of coordinates
+def haversine(latitude, longitude, latitudes, longitudes):
+    lat1, lat2 = np.radians(latitude), np.radians(latitudes)
+    a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(np.radians(longitudes - longitude) / 2)**2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+# the stops of a user sorted by the grid cell they lie in
+# keys:  key of every cell with stops (sorted), offsets: index of the first stop of every cell (and the number of stops)
+# scale: cos of the latitude the longitudes are projected with, the same for all queries of a user
+class StopIndex:
+    def __init__(self, keys, offsets, scale, latitude, longitude, start, stop, duration, unique_id, version=None):
+        self.keys = keys
+        self.offsets = offsets
+        self.scale = scale
+        self.latitude = latitude
+        self.longitude = longitude
+        self.start = start
+        self.stop = stop
+        self.duration = duration
+        self.unique_id = unique_id
+        self.version = version
+
+    def __len__(self):
+        return len(self.latitude)
+
+    def cells(self, latitude, longitude):
+        x = np.floor(np.asarray(longitude, dtype=np.float64) * self.scale * METERS_PER_DEGREE / GRID_CELL_METERS).astype(np.int64)
+        y = np.floor(np.asarray(latitude, dtype=np.float64) * METERS_PER_DEGREE / GRID_CELL_METERS).astype(np.int64)
+        return x, y
+
+    @staticmethod
+    def cellKey(x, y):
+        return (x + CELL_OFFSET) * 2 * CELL_OFFSET + (y + CELL_OFFSET)
+
+    @staticmethod
+    def fromStops(stops, version=None):
+        stops = stops.dropna(subset=["latitude", "longitude"])
+        latitude = stops["latitude"].to_numpy(dtype=np.float64)
+        longitude = stops["longitude"].to_numpy(dtype=np.float64)
+        scale = float(np.cos(np.radians(np.mean(latitude)))) if len(latitude) else 1.0
+
+        index = StopIndex(None, None, scale, latitude, longitude,
+                          # fixed-width strings, so the index can be saved and loaded without pickle
+                          stops["start"].astype(str).to_numpy(dtype=str), stops["stop"].astype(str).to_numpy(dtype=str),
+                          stops["duration"].to_numpy(dtype=np.float64), stops["unique_id"].to_numpy(dtype=np.int64), version)
+
+        # sort everything by cell, the stops of a cell keep their order
+        keys = StopIndex.cellKey(*index.cells(latitude, longitude))
+        order = np.argsort(keys, kind="stable")
+        for column in ("latitude", "longitude", "start", "stop", "duration", "unique_id"):
+            setattr(index, column, getattr(index, column)[order])
+        index.keys, first = np.unique(keys[order], return_index=True)
+        index.offsets = np.append(first, len(keys)).astype(np.int64)
+        return index
+
+    # returns the indexes of the stops within "radius" meters of the point, sorted by start
+    def query(self, latitude, longitude, radius):
+        x0, y0 = self.cells(latitude - radius / METERS_PER_DEGREE, longitude - radius / (METERS_PER_DEGREE * self.scale))
+        x1, y1 = self.cells(latitude + radius / METERS_PER_DEGREE, longitude + radius / (METERS_PER_DEGREE * self.scale))
+
+        # the cells of a column (same x) are next to each other, so every column is a single slice of the stops
+        # for huge radii it's faster to look at all stops
+        if x1 - x0 + 1 > len(self.keys):
+            candidates = np.arange(len(self))
+        else:
+            slices = []
+            for x in range(int(x0), int(x1) + 1):
+                first, last = np.searchsorted(self.keys, [self.cellKey(x, y0), self.cellKey(x, y1) + 1])
+                if first < last:
+                    slices.append(np.arange(self.offsets[first], self.offsets[last]))
+            candidates = np.concatenate(slices) if slices else np.zeros(0, dtype=np.int64)
+
+        distance = haversine(latitude, longitude, self.latitude[candidates], self.longitude[candidates])
+        within = distance <= radius
+        candidates, distance = candidates[within], distance[within]
+        # the timestamps all have the same format, so they are sorted as strings
+        order = np.argsort(self.start[candidates], kind="stable")
+        return candidates[order], distance[order]
+
+    # returns the visits within "radius" meters of the point as list of dictionaries, sorted by start
+    def visits(self, latitude, longitude, radius):
+        indexes, distance = self.query(latitude, longitude, radius)
+        return [{"start": str(self.start[i]), "stop": str(self.stop[i]), "duration": float(self.duration[i]),
+                 "latitude": float(self.latitude[i]), "longitude": float(self.longitude[i]),
+                 "unique_id": int(self.unique_id[i]), "distance": round(float(d), 1)}
+                for i, d in zip(indexes, distance)]
+
+    def save(self, file):
+        tmp = file + ".tmp-" + str(getpid()) + "-" + str(threading.get_ident())
+        with open(tmp, "wb") as f:
+            np.savez(f, format=np.array(INDEX_FORMAT_VERSION), version=np.array(self.version), keys=self.keys,
+                     offsets=self.offsets, scale=np.array(self.scale), latitude=self.latitude, longitude=self.longitude,
+                     start=self.start, stop=self.stop, duration=self.duration, unique_id=self.unique_id)
+        replace(tmp, file)
+
+    # returns the saved index, None if it doesn't exist, is outdated or broken (it is built again then)
+    @staticmethod
+    def load(file, version):
+        if not path.exists(file):
+            return None
+        try:
+            with np.load(file) as data:
+                if int(data["format"]) != INDEX_FORMAT_VERSION or str(data["version"]) != version:
+                    return None
+                return StopIndex(data["keys"], data["offsets"], float(data["scale"]), data["latitude"], data["longitude"],
+                                 data["start"], data["stop"], data["duration"], data["unique_id"], version)
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            print("Stop index '" + file + "' is broken, it will be rebuilt.")
+            return None
+
+
+class StopIndexStore:
+    def __init__(self, data_dir=DATA_DIR, max_entries=STOP_INDEX_MAX_ENTRIES):
+        self.data_dir = data_dir
+        self._indexes = LRUCache(max_entries)
+
+    def csvPath(self, username):
+        return path.join(self.data_dir, username, STOPS_FILE)
+
+    def indexPath(self, username):
+        return path.join(self.data_dir, username, INDEX_FILE)
+
+    # the version of an index changes whenever the csv is modified
+    def version(self, username):
+        st = stat(self.csvPath(username))
+        return str(st.st_mtime_ns) + "-" + str(st.st_size)
+
+    # returns the StopIndex of a user, raises FileNotFoundError if the user has no stops
+    def get(self, username):
+        version = self.version(username)
+
+        index = self._indexes.get(username)
+        if index is not None and index.version == version:
+            return index
+
+        index = StopIndex.load(self.indexPath(username), version)
+        if index is None:
+            index = StopIndex.fromStops(pd.read_csv(self.csvPath(username)), version)
+            try:
+                index.save(self.indexPath(username))
+            except OSError:
+                print("Stop index of user '" + username + "' couldn't be saved.")
+
+        self._indexes.put(username, index)
+        return index
+
+    # builds (or loads) the indexes of all given users
+    def load(self, usernames):
+        loaded = 0
+        for username in usernames:
+            try:
+                self.get(username)
+                loaded += 1
+            except FileNotFoundError:
+                print("User '" + username + "' has no stops.")
+        return loaded
+
+
+stop_indexes = StopIndexStore()
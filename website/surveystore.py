@@ -0,0 +1,91 @@
+import queue
+import threading
+from concurrent.futures import Future
+from datetime import datetime
+
+from . import db
+from .models import User, SurveyAnswer
+
+
+# Survey answers are saved in the database (table SurveyAnswer) by a single background thread.
+# Answers arriving while the thread is writing are collected and written together in the next transaction
+# (at most SURVEY_BATCH_SIZE at once), together with the users' "survey_part<N>_answered" flags, so an answer and its
+# flag are always saved together. A request waits until its answer has been saved (see receivedata_part1() in views.py).
+# "python export_survey.py" writes the answers into "surveyData/" as csv files.
+
+SURVEY_BATCH_SIZE = 100
+
+# how long a request waits for its answer to be saved
+SURVEY_WAIT_SECONDS = 30
+
+ANSWERED_FLAGS = {1: User.survey_part1_answered, 2: User.survey_part2_answered}
+
+
+class SurveyStore:
+    def __init__(self, batch_size=SURVEY_BATCH_SIZE):
+        self.batch_size = batch_size
+        self._app = None
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    # the thread needs the app to use its database
+    def init_app(self, app):
+        self._app = app
+
+    # queues the answer of a user to a part (1 or 2) of the survey, returns a Future, which is done when it is saved
+    def submit(self, user_id, part, data):
+        if part not in ANSWERED_FLAGS:
+            raise ValueError("The survey has no part " + str(part) + ".")
+
+        future = Future()
+        self._start()
+        self._queue.put((user_id, part, data, future))
+        return future
+
+    # the thread is started with the first answer, so scripts using the app (precompute.py, ...) don't start it
+    def _start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="survey-writer", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            # everything that arrived in the meantime is written in the same transaction
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _write(self, batch):
+        try:
+            with self._app.app_context():
+                try:
+                    received = datetime.now()
+                    for user_id, part, data, _ in batch:
+                        db.session.add(SurveyAnswer(user_id=user_id, part=part, data=data, received=received))
+
+                    for part, flag in ANSWERED_FLAGS.items():
+                        user_ids = {user_id for user_id, p, _, _ in batch if p == part}
+                        if user_ids:
+                            User.query.filter(User.id.in_(user_ids)).update({flag: True}, synchronize_session=False)
+
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                    raise
+        except Exception as e:
+            print("Error while saving " + str(len(batch)) + " survey answer(s): " + str(e))
+            for _, _, _, future in batch:
+                future.set_exception(e)
+            return
+
+        for _, _, _, future in batch:
+            future.set_result(None)
+
+
+survey_store = SurveyStore()
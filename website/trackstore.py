@@ -0,0 +1,423 @@
+import json
+import threading
+from os import path, makedirs, listdir, rename, getpid, stat, remove
+from shutil import rmtree
+
+import numpy as np
+import pandas as pd
+
+from .cache import LRUCache
+
+
+# Every user's "gps_samples_and_motion_score.csv" is converted once into a binary, columnar format
+# (one .npy file per column) and saved in "data/<user>/track_cache/<version>/".
+# The version is derived from the csv's modification time and size, so a changed csv is converted again.
+# The most recently used tracks are additionally kept in memory (see TRACK_CACHE_MAX_BYTES).
+# Csv files bigger than CHUNKED_CONVERSION_BYTES are converted in chunks of CSV_CHUNK_ROWS rows, so they never have
+# to be in memory as a whole. Very large tracks can then be read memory-mapped (see TrackStore.open).
+# Since the samples are sorted by time, the samples of every day are consecutive rows. A manifest of all days
+# ("days.json", see daySummaries) saves their rows, number of samples, first/last timestamp, bounding box and the
+# sums of their coordinates, so filters by date only read the rows of the days they need (see DayManifest.rows).
+
+DATA_DIR = "data/"
+TRACK_FILE = "gps_samples_and_motion_score.csv"
+CACHE_DIR = "track_cache"
+
+# increase this, if the binary format changes, so old caches aren't used anymore
+FORMAT_VERSION = 2
+
+# maximum number of bytes of tracks kept in memory
+TRACK_CACHE_MAX_BYTES = 128 * 1024 * 1024
+
+# maximum number of day manifests kept in memory
+DAY_MANIFEST_MAX_ENTRIES = 1000
+
+# csv files bigger than this are converted in chunks
+CHUNKED_CONVERSION_BYTES = 256 * 1024 * 1024
+CSV_CHUNK_ROWS = 500000
+
+COLUMNS = ("ts", "utc_offset", "latitude", "longitude", "motion_score", "stop_id")
+DTYPES = {"ts": np.int64, "utc_offset": np.int32, "latitude": np.float32, "longitude": np.float32,
+          "motion_score": np.float32, "stop_id": np.int32}
+
+
+# the track of a single user, every column is a numpy array of the same length, sorted by time
+# ts:           seconds since epoch (UTC), int64
+# utc_offset:   offset of the original timestamp to UTC in seconds (e.g. 7200 for "+02:00"), int32
+# latitude, longitude, motion_score: float32
+# stop_id:      unique_id of the stop the sample belongs to, -1 if it doesn't belong to a stop, int32
+class Track:
+    def __init__(self, ts, utc_offset, latitude, longitude, motion_score, stop_id, version=None, offset=0):
+        self.ts = ts
+        self.utc_offset = utc_offset
+        self.latitude = latitude
+        self.longitude = longitude
+        self.motion_score = motion_score
+        self.stop_id = stop_id
+        # identifies the source data the track was built from
+        self.version = version
+        # index of the first sample in the user's whole track, if this is a slice of it
+        self.offset = offset
+
+    def __len__(self):
+        return len(self.ts)
+
+    # slicing returns a new Track whose columns are views on this track's columns (no copy)
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            raise TypeError("Tracks can only be sliced.")
+        start, _, step = key.indices(len(self))
+        if step != 1:
+            raise ValueError("Tracks can only be sliced without step.")
+        return Track(*(getattr(self, c)[key] for c in COLUMNS), version=self.version, offset=self.offset + start)
+
+    # returns a copy of the track, which only contains the samples where mask is True
+    # the copy is no slice of the user's track anymore, so it has no offset
+    def take(self, mask):
+        return Track(*(getattr(self, c)[mask] for c in COLUMNS), version=self.version, offset=None)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, c).nbytes for c in COLUMNS)
+
+    # returns the samples with start <= ts <= end (seconds since epoch, UTC) as a view on this track
+    # binary search, since the samples are sorted by time
+    def between(self, start, end):
+        first = np.searchsorted(self.ts, start, side="left")
+        last = np.searchsorted(self.ts, end, side="right")
+        return self[first:max(first, last)]
+
+
+# parses timestamps like "2022-03-30 20:42:37+02:00"
+# returns seconds since epoch (UTC) and the utc offset of every timestamp in seconds
+def parseTimestamps(ts):
+    ts = ts.astype(str)
+
+    epoch = pd.to_datetime(ts, utc=True).values.astype("datetime64[s]").astype(np.int64)
+
+    offset = ts.str.extract(r"([+-])(\d{2}):?(\d{2})$")
+    sign = np.where(offset[0] == "-", -1, 1)
+    hours = pd.to_numeric(offset[1]).fillna(0).to_numpy()
+    minutes = pd.to_numeric(offset[2]).fillna(0).to_numpy()
+    utc_offset = (sign * (hours * 3600 + minutes * 60)).astype(np.int32)
+
+    return epoch, utc_offset
+
+
+def isTrackColumn(c):
+    return c in ("ts", "latitude", "longitude", "motion_score", "stop_id")
+
+
+# converts the rows of a csv file into a Track (unsorted)
+def trackFromFrame(data, version=None):
+    ts, utc_offset = parseTimestamps(data["ts"])
+
+    if "stop_id" in data:
+        stop_id = data["stop_id"].fillna(-1).to_numpy(dtype=np.int32)
+    else:
+        stop_id = np.full(len(data), -1, dtype=np.int32)
+
+    return Track(ts, utc_offset,
+                 data["latitude"].to_numpy(dtype=np.float32),
+                 data["longitude"].to_numpy(dtype=np.float32),
+                 data["motion_score"].to_numpy(dtype=np.float32),
+                 stop_id,
+                 version=version)
+
+
+# reads a track from csv, which is slow and should only happen once per version
+def readTrackCsv(csv_path, version=None):
+    track = trackFromFrame(pd.read_csv(csv_path, usecols=isTrackColumn), version)
+
+    # everything else relies on the samples being sorted by time
+    if len(track) > 1 and np.any(np.diff(track.ts) < 0):
+        order = np.argsort(track.ts, kind="stable")
+        track = Track(*(getattr(track, c)[order] for c in COLUMNS), version=version)
+
+    return track
+
+
+# converts a csv file into one .npy file per column in "directory", reading only chunk_rows rows at a time
+# the columns are first appended to raw files and then copied into .npy files (whose header needs the number of rows)
+# returns the number of samples
+def writeTrackChunked(csv_path, directory, chunk_rows=CSV_CHUNK_ROWS):
+    raw = {c: open(path.join(directory, c + ".raw"), "wb") for c in COLUMNS}
+    samples = 0
+    is_sorted = True
+    last = None
+    try:
+        for data in pd.read_csv(csv_path, usecols=isTrackColumn, chunksize=chunk_rows):
+            chunk = trackFromFrame(data)
+            if len(chunk) == 0:
+                continue
+            if np.any(np.diff(chunk.ts) < 0) or (last is not None and chunk.ts[0] < last):
+                is_sorted = False
+            last = chunk.ts[-1]
+            for c in COLUMNS:
+                raw[c].write(getattr(chunk, c).tobytes())
+            samples += len(chunk)
+    finally:
+        for f in raw.values():
+            f.close()
+
+    # everything else relies on the samples being sorted by time (only the order has to be in memory for this)
+    order = None
+    if not is_sorted:
+        order = np.argsort(np.memmap(path.join(directory, "ts.raw"), dtype=DTYPES["ts"], mode="r", shape=(samples,)),
+                           kind="stable")
+
+    for c in COLUMNS:
+        raw_file = path.join(directory, c + ".raw")
+        if samples == 0:
+            np.save(path.join(directory, c + ".npy"), np.zeros(0, dtype=DTYPES[c]))
+        else:
+            source = np.memmap(raw_file, dtype=DTYPES[c], mode="r", shape=(samples,))
+            target = np.lib.format.open_memmap(path.join(directory, c + ".npy"), mode="w+", dtype=DTYPES[c], shape=(samples,))
+            for start in range(0, samples, chunk_rows):
+                if order is None:
+                    target[start:start + chunk_rows] = source[start:start + chunk_rows]
+                else:
+                    target[start:start + chunk_rows] = source[order[start:start + chunk_rows]]
+            target.flush()
+            del source, target
+        remove(raw_file)
+
+    return samples
+
+
+# summarises the samples of every local day (the day of the original timestamp, see utc_offset)
+# returns a list of dictionaries sorted by day: day ("2022-03-30"), first and last row (exclusive) of the day's
+# samples, samples, start and end (first/last timestamp), the bounding box (south, west, north, east) and
+# latitude_sum, longitude_sum and located (number of samples with coordinates) for the mean location
+# the columns are read chunk by chunk, so they can be memory-mapped
+def daySummaries(ts, utc_offset, latitude, longitude, chunk_rows=CSV_CHUNK_ROWS):
+    days = {}
+    for start in range(0, len(ts), chunk_rows):
+        chunk_ts = np.asarray(ts[start:start + chunk_rows])
+        local_days = (chunk_ts + np.asarray(utc_offset[start:start + chunk_rows])) // 86400
+        lat = np.asarray(latitude[start:start + chunk_rows], dtype=np.float64)
+        lon = np.asarray(longitude[start:start + chunk_rows], dtype=np.float64)
+        located = ~(np.isnan(lat) | np.isnan(lon))
+
+        # runs of samples of the same day
+        change = np.flatnonzero(np.diff(local_days)) + 1
+        for first, last in zip(np.concatenate(([0], change)), np.append(change, len(chunk_ts))):
+            run = slice(first, last)
+            run_lat, run_lon = lat[run][located[run]], lon[run][located[run]]
+            summary = {"first": start + int(first), "last": start + int(last), "samples": int(last - first),
+                       "start": int(chunk_ts[first]), "end": int(chunk_ts[last - 1]),
+                       "south": float(run_lat.min()) if len(run_lat) else None,
+                       "west": float(run_lon.min()) if len(run_lon) else None,
+                       "north": float(run_lat.max()) if len(run_lat) else None,
+                       "east": float(run_lon.max()) if len(run_lon) else None,
+                       "latitude_sum": float(run_lat.sum()), "longitude_sum": float(run_lon.sum()), "located": len(run_lat)}
+
+            day = int(local_days[first])
+            if day in days:
+                summary = mergeDaySummaries(days[day], summary)
+            days[day] = summary
+
+    return [dict(day=str(np.datetime64(day, "D")), **days[day]) for day in sorted(days)]
+
+
+# the summary of two parts of the same day (e.g. split by chunks)
+def mergeDaySummaries(a, b):
+    def bound(function, key):
+        values = [v for v in (a[key], b[key]) if v is not None]
+        return function(values) if values else None
+
+    return {"first": min(a["first"], b["first"]), "last": max(a["last"], b["last"]), "samples": a["samples"] + b["samples"],
+            "start": min(a["start"], b["start"]), "end": max(a["end"], b["end"]),
+            "south": bound(min, "south"), "west": bound(min, "west"), "north": bound(max, "north"), "east": bound(max, "east"),
+            "latitude_sum": a["latitude_sum"] + b["latitude_sum"], "longitude_sum": a["longitude_sum"] + b["longitude_sum"],
+            "located": a["located"] + b["located"]}
+
+
+# the days of a user's track (see daySummaries)
+class DayManifest:
+    def __init__(self, days, version=None):
+        self.days = days
+        self.version = version
+        self._starts = np.array([d["start"] for d in days], dtype=np.int64)
+        self._ends = np.array([d["end"] for d in days], dtype=np.int64)
+        self._firsts = np.array([d["first"] for d in days], dtype=np.int64)
+        self._lasts = np.array([d["last"] for d in days], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.days)
+
+    # first and last day with samples ("2022-03-30"), empty if there are none
+    @property
+    def first_day(self):
+        return self.days[0]["day"] if self.days else ""
+
+    @property
+    def last_day(self):
+        return self.days[-1]["day"] if self.days else ""
+
+    # the rows (first, last exclusive) of all days with samples between start and end (seconds since epoch)
+    # all samples with start <= ts <= end lie within these rows
+    def rows(self, start, end):
+        overlapping = np.flatnonzero((self._starts <= end) & (self._ends >= start))
+        if len(overlapping) == 0:
+            return 0, 0
+        return int(self._firsts[overlapping].min()), int(self._lasts[overlapping].max())
+
+    # mean location of all samples (like meanLocation in map.py), NaN if there are none
+    def center(self):
+        located = sum(d["located"] for d in self.days)
+        if located == 0:
+            return float("nan"), float("nan")
+        return (sum(d["latitude_sum"] for d in self.days) / located, sum(d["longitude_sum"] for d in self.days) / located)
+
+
+class TrackStore:
+    def __init__(self, data_dir=DATA_DIR, max_bytes=TRACK_CACHE_MAX_BYTES):
+        self.data_dir = data_dir
+        self._tracks = LRUCache(max_bytes)
+        self._days = LRUCache(DAY_MANIFEST_MAX_ENTRIES)
+        # one lock per user, so a track is never converted twice at the same time
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def csvPath(self, username):
+        return path.join(self.data_dir, username, TRACK_FILE)
+
+    def cacheDir(self, username):
+        return path.join(self.data_dir, username, CACHE_DIR)
+
+    # the version of a user's track changes whenever the csv is modified
+    def version(self, username):
+        st = stat(self.csvPath(username))
+        return str(FORMAT_VERSION) + "-" + str(st.st_mtime_ns) + "-" + str(st.st_size)
+
+    def _lock(self, username):
+        with self._locks_lock:
+            return self._locks.setdefault(username, threading.Lock())
+
+    # returns the Track of a user, raises FileNotFoundError if the user has no track
+    def get(self, username):
+        version = self.version(username)
+
+        track = self._tracks.get(username)
+        if track is not None and track.version == version:
+            return track
+
+        with self._lock(username):
+            # another thread might have loaded it in the meantime
+            track = self._tracks.get(username)
+            if track is not None and track.version == version:
+                return track
+
+            track = self._readBinary(username, version)
+            if track is None:
+                track = self._convert(username, version)
+
+            self._tracks.put(username, track, track.nbytes)
+            return track
+
+    # returns the Track of a user with its columns memory-mapped from the binary cache instead of loaded into memory,
+    # so parts of it can be read without reading the whole track (see buildStreamingMap in map.py)
+    # the track isn't kept in memory by the store
+    def open(self, username):
+        version = self.version(username)
+        with self._lock(username):
+            track = self._readBinary(username, version, mmap=True)
+            if track is None:
+                converted = self._convert(username, version)
+                # the converted track is only used, if the cache couldn't be written
+                track = self._readBinary(username, version, mmap=True)
+                if track is None:
+                    track = converted
+            return track
+
+    # returns the DayManifest of a user's track, raises FileNotFoundError if the user has no track
+    def days(self, username):
+        version = self.version(username)
+
+        manifest = self._days.get(username)
+        if manifest is not None and manifest.version == version:
+            return manifest
+
+        manifest = self._readDays(username, version)
+        if manifest is None:
+            # the track hasn't been converted yet, or its cache couldn't be written
+            track = self.open(username)
+            manifest = self._readDays(username, version)
+            if manifest is None:
+                manifest = DayManifest(daySummaries(track.ts, track.utc_offset, track.latitude, track.longitude), version)
+
+        self._days.put(username, manifest)
+        return manifest
+
+    def _readDays(self, username, version):
+        try:
+            with open(path.join(self.cacheDir(username), version, "days.json")) as f:
+                return DayManifest(json.load(f), version)
+        except (OSError, ValueError):
+            return None
+
+    # converts the user's csv into the binary format, returns the track
+    # big csv files are converted in chunks and the result is memory-mapped
+    def _convert(self, username, version):
+        csv_path = self.csvPath(username)
+        if stat(csv_path).st_size > CHUNKED_CONVERSION_BYTES:
+            self._publish(username, version, lambda directory: writeTrackChunked(csv_path, directory))
+            track = self._readBinary(username, version, mmap=True)
+            if track is not None:
+                return track
+
+        track = readTrackCsv(csv_path, version)
+        self._writeBinary(username, track)
+        return track
+
+    def _readBinary(self, username, version, mmap=False):
+        directory = path.join(self.cacheDir(username), version)
+        if not path.exists(path.join(directory, "meta.json")):
+            return None
+        try:
+            columns = [np.load(path.join(directory, c + ".npy"), mmap_mode="r" if mmap else None) for c in COLUMNS]
+        except (OSError, ValueError):
+            print("Track cache of user '" + username + "' is broken, it will be rebuilt.")
+            return None
+        return Track(*columns, version=version)
+
+    def _writeBinary(self, username, track):
+        def write(directory):
+            for c in COLUMNS:
+                np.save(path.join(directory, c + ".npy"), getattr(track, c))
+            return len(track)
+
+        self._publish(username, track.version, write)
+
+    # "write" writes the columns into the given directory and returns the number of samples
+    def _publish(self, username, version, write):
+        cache_dir = self.cacheDir(username)
+        directory = path.join(cache_dir, version)
+
+        # write into a temporary directory first, so other processes never see half-written caches
+        tmp = path.join(cache_dir, "tmp-" + str(getpid()) + "-" + str(threading.get_ident()))
+        try:
+            makedirs(tmp, exist_ok=True)
+            samples = write(tmp)
+            columns = [np.load(path.join(tmp, c + ".npy"), mmap_mode="r") for c in ("ts", "utc_offset", "latitude", "longitude")]
+            with open(path.join(tmp, "days.json"), "w") as f:
+                json.dump(daySummaries(*columns), f)
+            del columns
+            with open(path.join(tmp, "meta.json"), "w") as f:
+                json.dump({"version": version, "samples": samples}, f)
+            rename(tmp, directory)
+        except OSError:
+            # e.g. another process already wrote the same version or the directory isn't writable
+            rmtree(tmp, ignore_errors=True)
+
+        if not path.exists(cache_dir):
+            return
+
+        # remove caches of older versions
+        for entry in listdir(cache_dir):
+            if entry != version and not entry.startswith("tmp-"):
+                rmtree(path.join(cache_dir, entry), ignore_errors=True)
+
+
+track_store = TrackStore()
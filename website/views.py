@@ -1,12 +1,24 @@
-from flask import Blueprint, render_template, redirect, url_for, request
+from flask import Blueprint, render_template, redirect, url_for, request, current_app
 from flask_login import login_required, current_user
 from website.map import buildmap
 from website.map import metadata
 from website.map import build_date_map
-from os import path, mkdir
-from flask import send_file
-from . import db
-from random import randint
+from website.map import mapVersion
+from website.map import trackGeoJSON
+from website.map import validFilter
+from website.map import snapshotUser
+from .rendercache import map_cache
+from .trackstore import track_store
+from .renderpool import render_pool
+from .surveystore import survey_store, SURVEY_WAIT_SECONDS
+from .assets import asset_index
+from .densitygrid import density_grids, CELL_PIXELS
+from .stopindex import stop_indexes
+from .auth import PW_DB
+from flask import abort, jsonify, session
+from werkzeug.security import check_password_hash
+from concurrent.futures import TimeoutError
+import numpy as np
 # create a new blueprint, which defines how the website can be accessed
 views = Blueprint('views', __name__,)
 
@@ -21,27 +33,46 @@ def home():
 
 variable = "variables can be passed this way"
 
+# how long "/displaymap/" waits for a map, which is still being built, before it sends MAP_PLACEHOLDER instead
+DISPLAY_MAP_WAIT_SECONDS = 5
+
+# shown in the iframe while the map is being built, reloads itself until the map is done
+MAP_PLACEHOLDER = '''<html><head><meta http-equiv="refresh" content="2"></head>
+<body style="font-family: Arial, Helvetica, sans-serif;">The map is being built, please wait...</body></html>'''
+
+MAP_FAILED = '''<html><body style="font-family: Arial, Helvetica, sans-serif;">
+The map could not be built, please reload the page.</body></html>'''
+
+# if True, the map is rendered in the browser (see trackmap.html and track_api()) instead of on the server with folium
+# the base map is then only loaded once and changing the filter only fetches the track again
+CLIENT_SIDE_MAP = False
+
 @views.route("/map/", methods=['GET', 'POST'])
 @login_required
 def map():
 
     if request.method == 'POST':
-        random_number = randint(1, 9999999999)
 
         # getting values from html form
-        start_date = request.form.get('start_date')
-        end_date = request.form.get('end_date')
-        start_time = request.form.get('start_time')
-        end_time = request.form.get('end_time')
-        build_date_map(current_user, start_date,
-                       end_date, start_time, end_time, random_number)
+        start_date = request.form.get('start_date') or ""
+        end_date = request.form.get('end_date') or ""
+        start_time = request.form.get('start_time') or ""
+        end_time = request.form.get('end_time') or ""
+
+        if CLIENT_SIDE_MAP:
+            return renderMap(client_side_map=True,
+                             filter=dict(start_date=start_date, end_date=end_date, start_time=start_time, end_time=end_time))
+
+        # the map is only built, if it hasn't been built before (see rendercache.py), a cached map is touched, so it
+        # isn't deleted before the iframe requests it
+        # it is built in the background (see renderpool.py), the iframe waits for it (see map1())
+        user = snapshotUser(current_user)
+        map_key = map_cache.key(user.id, "date_map", start_date, end_date, start_time, end_time, mapVersion(user))
+        if not map_cache.touch(map_key):
+            if render_pool.submit(map_key, lambda: build_date_map(user, start_date, end_date, start_time, end_time)) is None:
+                return serverBusy()
         # add metadata
-
-        
-
-        df_metadata = metadata(current_user)
-        temp = render_template("map.html", Metadata=zip(
-            df_metadata.columns, df_metadata.loc[0]), df_metadata=df_metadata, random_number = random_number)
+        temp = renderMap(map_key = map_key)
         #print(str(start), file=sys.stdout)
         return temp
 
@@ -50,26 +81,129 @@ def map():
         if not current_user.survey_part1_answered:
             return redirect(url_for("views.survey_part1"))
 
-        #check discreption of folder 'iframes' in the readme.md to understand why the following is necessary
-        random_number = randint(1, 9999999999)
+        if CLIENT_SIDE_MAP:
+            return renderMap(client_side_map=True, filter={})
 
-        buildmap(current_user, random_number)
+        #check discreption of folder 'iframes' in the readme.md to understand how maps are cached
+        user = snapshotUser(current_user)
+        map_key = map_cache.key(user.id, "map", mapVersion(user))
+        if not map_cache.touch(map_key):
+            if render_pool.submit(map_key, lambda: buildmap(user)) is None:
+                return serverBusy()
         # add metadata
-        df_metadata = metadata(current_user)
-
-        return render_template("map.html", Metadata=zip(df_metadata.columns, df_metadata.loc[0]), df_metadata=df_metadata, random_number = random_number)
+        return renderMap(map_key = map_key)
 
 
 @views.route("/displaymap/")
 @login_required
 def map1():
-    random_number = request.args.get("random_number")
+    map_key = request.args.get("map_key")
 
     if not current_user.survey_part1_answered:
             return redirect(url_for("views.survey_part1"))
-            
-    temp = render_template("iframes/map"+random_number+".html")
-    return temp
+
+    # users can only see their own maps
+    if not map_cache.belongsTo(map_key, current_user.id):
+        abort(404)
+
+    # wait a little, if the map is still being built, and let the iframe reload itself, if it takes longer
+    job = render_pool.job(map_key)
+    if job is not None:
+        try:
+            job.result(timeout=DISPLAY_MAP_WAIT_SECONDS)
+        except TimeoutError:
+            return MAP_PLACEHOLDER
+        except Exception:
+            return MAP_FAILED
+
+    # with several server processes, the map may be built by another process, which this one doesn't know about,
+    # so it is only reported as failed, if it has been built here
+    if not map_cache.exists(map_key):
+        if render_pool.failed(map_key):
+            return MAP_FAILED
+        return MAP_PLACEHOLDER
+
+    # the map is sent as it is (compressed, if possible), without going through jinja again
+    return map_cache.send(map_key)
+
+
+# map.html with the user's mobility report and the days with samples (limits of the date filter, see trackstore.py)
+def renderMap(**kwargs):
+    return render_template("map.html", report=metadata(current_user), days=track_store.days(current_user.username), **kwargs)
+
+
+# answer if there are too many maps being built already (see renderpool.py)
+def serverBusy():
+    return "The server is busy right now, please try again in a few seconds.", 503, {"Retry-After": "5"}
+
+
+# page with an empty map, which loads the track from track_api() (used if CLIENT_SIDE_MAP is set)
+@views.route("/trackmap/")
+@login_required
+def trackmap():
+    if not current_user.survey_part1_answered:
+            return redirect(url_for("views.survey_part1"))
+
+    return render_template("trackmap.html")
+
+
+# returns the user's (filtered) track and significant locations as GeoJSON
+# takes the same parameters as the filter form in map.html and optionally the zoom level the track is simplified for
+@views.route("/api/track/")
+@login_required
+def track_api():
+    if not current_user.survey_part1_answered:
+        abort(403)
+
+    start_date = request.args.get("start_date", "")
+    end_date = request.args.get("end_date", "")
+    start_time = request.args.get("start_time", "")
+    end_time = request.args.get("end_time", "")
+    # the form always sends all fields, like map() the track counts as filtered as soon as it has been submitted
+    filtered = any(field in request.args for field in ("start_date", "end_date", "start_time", "end_time"))
+    if not validFilter(start_date, end_date, start_time, end_time):
+        abort(400)
+    zoom = request.args.get("zoom", type=int)
+    if zoom is not None:
+        zoom = min(max(zoom, 0), 18)
+
+    # the response only changes with the user's data, so browsers can revalidate instead of downloading it again
+    user = current_user._get_current_object()
+    etag = map_cache.key(user.id, "geojson", filtered, start_date, end_date, start_time, end_time, zoom, mapVersion(user))
+    if etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+    else:
+        response = jsonify(trackGeoJSON(user, start_date, end_date, start_time, end_time, filtered, zoom))
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+# the user's stops within "radius" meters (default: VISIT_RADIUS, at most MAX_VISIT_RADIUS) of "lat", "lon"
+# e.g. "/api/visits/?lat=54.52&lon=13.25&radius=200", the visits are sorted by start (see stopindex.py)
+VISIT_RADIUS = 200
+MAX_VISIT_RADIUS = 100000
+
+@views.route("/api/visits/")
+@login_required
+def visits_api():
+    if not current_user.survey_part1_answered:
+        abort(403)
+
+    latitude = request.args.get("lat", type=float)
+    longitude = request.args.get("lon", type=float)
+    radius = request.args.get("radius", VISIT_RADIUS, type=float)
+    if latitude is None or longitude is None or not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+        abort(400)
+    if not 0 <= radius <= MAX_VISIT_RADIUS:
+        abort(400)
+
+    try:
+        index = stop_indexes.get(current_user.username)
+    except FileNotFoundError:
+        abort(404)
+    return jsonify({"visits": index.visits(latitude, longitude, radius)})
 
 
 @views.route("/survey_part1/")
@@ -96,49 +230,92 @@ def survey_part2():
 @login_required
 def receivedata_part1():
 
-    saveSurveyData(request.data, "part1/")
+    saveSurveyData(request.data, 1)
 
-    current_user.survey_part1_answered = True
-    db.session.commit()
-    print(current_user.username + " answered survey part 1: "+str(current_user.survey_part1_answered))
+    print(current_user.username + " answered survey part 1.")
     return ""
 
 @views.route("/receivedata_part2/", methods=['POST'])
 @login_required
 def receivedata_part2():
 
-    saveSurveyData(request.data, "part2/")
-    current_user.survey_part2_answered = True
-    db.session.commit()
-    print(current_user.username + " answered survey part 2: "+str(current_user.survey_part2_answered))
-    
-    return ""
+    saveSurveyData(request.data, 2)
 
-def saveSurveyData(data, directory):
-    
-    data = request.data
-    
-    if not path.exists('surveyData/'):
-        mkdir("surveyData/")
-    if not path.exists('surveyData/'+directory):
-        mkdir("surveyData/"+directory)
+    print(current_user.username + " answered survey part 2.")
+    return ""
 
+# saves the answers of the current user to a part of the survey and marks the part as answered (see surveystore.py)
+# waits until both are saved, so the user isn't sent to the same part again
+def saveSurveyData(data, part):
 
-    with open("surveyData/"+directory+current_user.username+".csv", "wb") as binary_file:
-        
-        # data starts with : 'data="Screen index","Type of[...]'
-        #get rid of 'data='
-        data = data[5:]
-        binary_file.write(data)
+    # data starts with : 'data="Screen index","Type of[...]'
+    #get rid of 'data='
+    data = data[5:]
 
-    if not path.exists("surveyData/"+directory+current_user.username+".csv"):
-        print("Error while saving survey data for user "+current_user.username+" in "+directory+".")
-    
+    survey_store.submit(current_user.id, part, data).result(timeout=SURVEY_WAIT_SECONDS)
 
 
 
+#images of the survey, answered with "304 Not Modified" if the browser already has them (see assets.py)
 @views.route('/get_image')
 def get_image():
     img = request.args.get("image")
-    directory ="./templates/img/"
-    return send_file(directory+img, mimetype='image/gif')
\ No newline at end of file
+    return asset_index.send("img", img)
+
+
+#files in "templates/img/", "templates/css/" and "templates/js/" (see assets.py)
+@views.route('/assets/<directory>/<filename>')
+def asset(directory, filename):
+    return asset_index.send(directory, filename)
+
+
+# heatmap of where the whole cohort spends its time, only for researchers (password PW_DB in auth.py)
+# the grid is computed beforehand by compute_density.py (see densitygrid.py), the map fetches the cells in view
+@views.route("/admin/density/", methods=['GET', 'POST'])
+def density_map():
+    if request.method == 'POST':
+        if not check_password_hash(PW_DB, request.form.get("admin_password") or ""):
+            return "wrong pw, pw can be found in auth.py"
+        session["admin"] = True
+        return redirect(url_for("views.density_map"))
+
+    if not session.get("admin"):
+        return '''<form method="POST">
+            Enter password to see where the cohort spends its time.
+            <div class="form-group">
+                <input
+                type="password"
+                class="form-control"
+                id="password"
+                name="admin_password"
+                />
+            </div>
+            <button type="submit" >Submit</button>
+        </form>'''
+
+    grid = density_grids.get()
+    if grid is None:
+        return "No density grid has been computed yet, run \"python compute_density.py\" from the main directory."
+    return render_template("densitymap.html", grid=grid, cell_pixels=CELL_PIXELS)
+
+
+# returns the cells of the density grid within the bounds for the zoom level (see DensityGrid.cells)
+# as [[latitude, longitude, weight], ...]
+@views.route("/api/density/")
+def density_api():
+    if not session.get("admin"):
+        abort(403)
+
+    grid = density_grids.get()
+    if grid is None:
+        abort(404)
+
+    zoom = request.args.get("zoom", 0, type=int)
+    bounds = [request.args.get(b, type=float) for b in ("south", "west", "north", "east")]
+    if None in bounds:
+        abort(400)
+
+    zoom, latitude, longitude, weights = grid.cells(zoom, *bounds)
+    cells = np.column_stack((np.round(latitude, 6), np.round(longitude, 6), weights.astype(np.float64))).tolist()
+    return jsonify({"zoom": zoom, "cells": cells, "max": float(weights.max()) if len(weights) else 0.0})
+